@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк transcribe-сервиса: синтетические записи + локальные заглушки провайдеров.
+
+Генерирует N записей ffmpeg'ом (шум в полосе речи, паузы по --silence), поднимает
+заглушки SpeechKit / Whisper / AssemblyAI с задержкой и ошибками, запускает
+services/transcribe/transcribe_server.py против них и ставит все записи в очередь.
+Отчёт: пропускная способность, задержка на файл (p50/p95), время этапов
+(hash, vad, segment, transcode, recognize, db_write — из /health → stages),
+пиковый RSS сервера, тарифицируемые секунды (processed_files).
+
+Нужны ffmpeg и PostgreSQL с миграцией v3 (DB_DSN или POSTGRES_*, как у сервиса).
+Строки processed_files прогона удаляются в конце.
+
+Использование:
+  python scripts/bench_transcribe.py --provider speechkit --files 20 --duration 300 --silence 0.3
+  python scripts/bench_transcribe.py --provider whisper --latency 2 --error-rate 0.05 --workers 4
+  python scripts/bench_transcribe.py --provider speechkit --max-p95 30 --json > bench.json
+
+Код выхода 1 — есть ошибки или p95 задержки больше --max-p95 (проверка перед деплоем).
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'services', 'transcribe',
+                      'transcribe_server.py')
+PROVIDERS = ('speechkit', 'whisper', 'assemblyai')
+# Цикл паузы: из каждых PAUSE_CYCLE_SEC секунд доля --silence — тишина
+PAUSE_CYCLE_SEC = 10
+
+
+def log(msg):
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}", file=sys.stderr, flush=True)
+
+
+def build_db_dsn():
+    dsn = os.getenv('DB_DSN', '')
+    if dsn:
+        return dsn
+    host = os.getenv('POSTGRES_HOST', 'localhost')
+    port = os.getenv('POSTGRES_PORT', '5432')
+    dbname = os.getenv('POSTGRES_DB', 'n8n')
+    user = os.getenv('POSTGRES_USER', 'n8n')
+    password = os.getenv('POSTGRES_PASSWORD', '')
+    return f"host={host} port={port} dbname={dbname} user={user} password={password}"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else None
+
+
+# ── Синтетические записи ──────────────────────────────────────────────────────
+
+def make_recording(path, duration, silence, seed):
+    """Розовый шум в полосе речи (200–3400 Hz) с паузами: доля silence каждого цикла — тишина."""
+    speech = PAUSE_CYCLE_SEC * (1 - silence)
+    cmd = [
+        'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'anoisesrc=d={duration}:c=pink:r=16000:a=0.3:seed={seed}',
+        '-af', f"highpass=f=200,lowpass=f=3400,volume='lt(mod(t,{PAUSE_CYCLE_SEC}),{speech:.2f})':eval=frame",
+        '-ac', '1', path
+    ]
+    subprocess.run(cmd, check=True, timeout=600)
+
+
+# ── Заглушки провайдеров ─────────────────────────────────────────────────────
+
+class StubState:
+    def __init__(self, latency, error_rate):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = {}
+        self.errors = {}
+        self.transcripts = {}  # AssemblyAI: id → время готовности
+        self.lock = threading.Lock()
+
+    def count(self, kind, error=False):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            if error:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def stub_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, code, data):
+            body = json.dumps(data).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _fail(self, kind):
+            """Ошибка с вероятностью error_rate — 503, как у перегруженного провайдера."""
+            if random.random() < state.error_rate:
+                state.count(kind, error=True)
+                self._reply(503, {'error': 'stub overloaded'})
+                return True
+            state.count(kind)
+            return False
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            size = len(self.rfile.read(length)) if length else 0
+            path = urllib.parse.urlsplit(self.path).path
+            if path == '/speechkit':
+                time.sleep(state.latency * random.uniform(0.8, 1.2))
+                if not self._fail('speechkit'):
+                    self._reply(200, {'result': f'чанк {size} байт'})
+            elif path == '/v1/audio/transcriptions':
+                time.sleep(state.latency * random.uniform(0.8, 1.2))
+                if not self._fail('whisper'):
+                    self._reply(200, {'text': f'файл {size} байт', 'segments': [
+                        {'start': 0.0, 'end': 5.0, 'text': f'файл {size} байт'}]})
+            elif path == '/v2/upload':
+                if not self._fail('assemblyai_upload'):
+                    self._reply(200, {'upload_url': f'http://stub/{uuid.uuid4().hex}'})
+            elif path == '/v2/transcript':
+                if not self._fail('assemblyai_submit'):
+                    transcript_id = uuid.uuid4().hex
+                    with state.lock:
+                        state.transcripts[transcript_id] = time.monotonic() + state.latency
+                    self._reply(200, {'id': transcript_id, 'status': 'queued'})
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_GET(self):
+            path = urllib.parse.urlsplit(self.path).path
+            if not path.startswith('/v2/transcript/'):
+                self._reply(404, {'error': 'not found'})
+                return
+            if self._fail('assemblyai_poll'):
+                return
+            ready_at = state.transcripts.get(path.rsplit('/', 1)[-1])
+            if ready_at is None:
+                self._reply(404, {'error': 'unknown transcript'})
+            elif time.monotonic() < ready_at:
+                self._reply(200, {'status': 'processing'})
+            else:
+                self._reply(200, {'status': 'completed', 'text': 'текст заглушки',
+                                  'words': [{'start': 0, 'end': 900, 'text': 'текст'},
+                                            {'start': 1000, 'end': 1900, 'text': 'заглушки.'}]})
+
+    return Handler
+
+
+# ── Прогон ───────────────────────────────────────────────────────────────────
+
+def http_json(method, url, data=None, timeout=130):
+    req = urllib.request.Request(url, data=json.dumps(data).encode() if data is not None else None,
+                                 method=method, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        return json.loads(r.read())
+
+
+def peak_rss_mb(pid):
+    """VmHWM процесса (Linux) — пиковый RSS за всё время жизни."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def wait_done(base, filename, deadline):
+    while time.monotonic() < deadline:
+        r = http_json('POST', base + '/check', {'filename': filename, 'wait': 60})
+        if r['status'] in ('completed', 'error'):
+            return r['status'], time.monotonic()
+    return 'timeout', time.monotonic()
+
+
+def db_billing(dsn, filenames, cleanup):
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute(
+            """SELECT COALESCE(SUM(audio_seconds), 0), COALESCE(SUM(billed_seconds), 0),
+                      COALESCE(SUM(billed_seconds_saved), 0)
+               FROM processed_files WHERE filename = ANY(%s)""",
+            (filenames,)
+        )
+        audio, billed, saved = cur.fetchone()
+        if cleanup:
+            cur.execute('DELETE FROM processed_files WHERE filename = ANY(%s)', (filenames,))
+    return {'audio_seconds': round(audio), 'billed_seconds': int(billed), 'billed_seconds_saved': int(saved)}
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='bench_transcribe_')
+    stub_port, port = free_port(), free_port()
+    stub = StubState(args.latency, args.error_rate)
+    stub_server = ThreadingHTTPServer(('127.0.0.1', stub_port), stub_handler(stub))
+    threading.Thread(target=stub_server.serve_forever, daemon=True).start()
+    stub_url = f'http://127.0.0.1:{stub_port}'
+    server = None
+    try:
+        day = time.strftime('%Y-%m-%d')
+        names = [f'99999_{day}_bench-{i:03d}.wav' for i in range(args.files)]
+        log(f'Генерация {args.files} записей по {args.duration}s (тишина {args.silence:.0%})...')
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 2) as pool:
+            list(pool.map(lambda i: make_recording(os.path.join(workdir, names[i]), args.duration,
+                                                   args.silence, seed=i + 1), range(args.files)))
+
+        env = {
+            **os.environ,
+            'STT_PROVIDER': args.provider, 'STT_ROUTES': args.provider,
+            'TRANSCRIBE_PORT': str(port), 'TRANSCRIBE_WORKERS': str(args.workers),
+            'TRANSCRIPT_CACHE': '0', 'DB_DSN': args.dsn,
+            'YANDEX_API_KEY': 'bench', 'SPEECHKIT_URL': stub_url + '/speechkit',
+            'WHISPER_URL': stub_url,
+            'ASSEMBLYAI_API_KEY': 'bench', 'ASSEMBLYAI_BASE_URL': stub_url, 'ASSEMBLYAI_WEBHOOK_BASE_URL': '',
+        }
+        env.update(kv.split('=', 1) for kv in args.env)
+        server_log = open(os.path.join(workdir, 'server.log'), 'wb')
+        server = subprocess.Popen([sys.executable, SERVER], env=env, stdout=server_log, stderr=subprocess.STDOUT)
+        base = f'http://127.0.0.1:{port}'
+        for _ in range(100):
+            try:
+                http_json('GET', base + '/livez', timeout=2)
+                break
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError(f'transcribe_server exited, see {workdir}/server.log')
+                time.sleep(0.1)
+
+        log(f'Прогон: {args.provider}, {args.workers} воркеров, задержка {args.latency}s, '
+            f'ошибки {args.error_rate:.0%}')
+        start = time.monotonic()
+        submitted = {}
+        for name in names:
+            http_json('POST', base + '/', {'filepath': os.path.join(workdir, name), 'filename': name})
+            submitted[name] = time.monotonic()
+        deadline = start + args.timeout
+        with ThreadPoolExecutor(max_workers=min(64, args.files)) as pool:
+            results = dict(zip(names, pool.map(lambda n: wait_done(base, n, deadline), names)))
+        wall = time.monotonic() - start
+
+        health = http_json('GET', base + '/health', timeout=10)
+        rss = peak_rss_mb(server.pid)
+        latencies = [done - submitted[n] for n, (status, done) in results.items() if status == 'completed']
+        statuses = [status for status, _ in results.values()]
+        audio_total = args.files * args.duration
+        report = {
+            'provider': args.provider, 'files': args.files, 'duration_sec': args.duration,
+            'silence': args.silence, 'workers': args.workers, 'stub_latency_sec': args.latency,
+            'stub_error_rate': args.error_rate,
+            'completed': statuses.count('completed'), 'errors': statuses.count('error'),
+            'timeouts': statuses.count('timeout'),
+            'wall_sec': round(wall, 2),
+            'files_per_min': round(len(latencies) / wall * 60, 2),
+            'audio_sec_per_sec': round(audio_total / wall, 1),
+            'latency_p50_sec': round(percentile(latencies, 0.5), 2) if latencies else None,
+            'latency_p95_sec': round(percentile(latencies, 0.95), 2) if latencies else None,
+            'latency_max_sec': round(max(latencies), 2) if latencies else None,
+            'stages': health.get('stages', {}),
+            'peak_rss_mb': round(rss, 1) if rss else None,
+            'billing': db_billing(args.dsn, names, cleanup=not args.keep),
+            'stub_requests': stub.requests, 'stub_errors': stub.errors,
+        }
+        return report, workdir
+    finally:
+        if server:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        stub_server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(r):
+    print(f"{r['provider']}: {r['files']} × {r['duration_sec']}s (тишина {r['silence']:.0%}), "
+          f"воркеров {r['workers']}, заглушка {r['stub_latency_sec']}s / ошибки {r['stub_error_rate']:.0%}")
+    print(f"  готово {r['completed']}, ошибок {r['errors']}, таймаутов {r['timeouts']}, за {r['wall_sec']}s")
+    print(f"  пропускная способность: {r['files_per_min']} файлов/мин, {r['audio_sec_per_sec']} с аудио/с")
+    print(f"  задержка на файл: p50 {r['latency_p50_sec']}s, p95 {r['latency_p95_sec']}s, "
+          f"max {r['latency_max_sec']}s")
+    print('  этапы (замеров, p50 / p95, сумма):')
+    for stage, s in sorted(r['stages'].items()):
+        print(f"    {stage:<10} {s['count']:>6}  {s['p50_sec']:>8.3f} / {s['p95_sec']:<8.3f} {s['total_sec']:>9.1f}s")
+    print(f"  пиковый RSS сервера: {r['peak_rss_mb']} MB")
+    b = r['billing']
+    print(f"  тарифицируемо: {b['billed_seconds']}s из {b['audio_seconds']}s аудио "
+          f"(VAD сэкономил {b['billed_seconds_saved']}s)")
+    print(f"  запросов к заглушкам: {r['stub_requests']}, ошибок: {r['stub_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк transcribe_server.py на заглушках провайдеров')
+    parser.add_argument('--provider', choices=PROVIDERS, default='speechkit')
+    parser.add_argument('--files', type=int, default=10, help='Число записей')
+    parser.add_argument('--duration', type=int, default=120, help='Длительность записи, сек')
+    parser.add_argument('--silence', type=float, default=0.3, help='Доля тишины, 0..1')
+    parser.add_argument('--workers', type=int, default=4, help='TRANSCRIBE_WORKERS')
+    parser.add_argument('--latency', type=float, default=0.5, help='Задержка заглушки на запрос, сек')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 503 от заглушки')
+    parser.add_argument('--timeout', type=int, default=1800, help='Предел на весь прогон, сек')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Доп. переменная окружения сервера (можно несколько раз)')
+    parser.add_argument('--dsn', default=build_db_dsn(), help='PostgreSQL DSN (по умолчанию DB_DSN / POSTGRES_*)')
+    parser.add_argument('--keep', action='store_true', help='Не удалять записи, лог сервера и строки БД')
+    parser.add_argument('--json', action='store_true', help='Отчёт в JSON (stdout)')
+    parser.add_argument('--max-p95', type=float, help='Порог p95 задержки на файл, сек (иначе код выхода 1)')
+    args = parser.parse_args()
+
+    report, workdir = run(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    if args.keep:
+        log(f'Записи и server.log: {workdir}')
+
+    failed = report['errors'] or report['timeouts']
+    if args.max_p95 is not None and (report['latency_p95_sec'] or 0) > args.max_p95:
+        log(f"p95 {report['latency_p95_sec']}s > {args.max_p95}s")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+-- ============================================================
+-- MVP Auto-Summary: Database Migration v3 — transcribe service
+-- Дата: 2026-10-18
+-- Применить: docker exec mvp-autosummary-postgres-1 psql -U n8n -d n8n -f /scripts/migrate_db_v3.sql
+-- ============================================================
+
+-- 1. Очередь задач транскрибации в processed_files
+--    status: queued → transcribing (lease) → completed | error
+--    priority: больше = раньше; внутри приоритета — FIFO по queued_at (с п. 11 — по sched_at)
+--    lease_owner / lease_expires_at / heartbeat_at: аренда задачи воркером,
+--    просроченная аренда (воркер упал, контейнер перезапущен) → снова queued
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS priority         INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS queued_at        TIMESTAMPTZ;
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS lease_owner      VARCHAR(200);
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS heartbeat_at     TIMESTAMPTZ;
+
+-- Выборка следующей задачи (ORDER BY priority DESC, queued_at, id ... SKIP LOCKED)
+CREATE INDEX IF NOT EXISTS idx_processed_files_queue
+    ON processed_files(priority DESC, queued_at, id)
+    WHERE status = 'queued';
+
+-- Поиск просроченных аренд
+CREATE INDEX IF NOT EXISTS idx_processed_files_lease
+    ON processed_files(lease_expires_at)
+    WHERE status = 'transcribing';
+
+-- 2. Учёт тарифицируемых секунд (SpeechKit + VAD)
+--    audio_seconds: длительность записи; billed_seconds: сколько выставит провайдер;
+--    billed_seconds_saved: экономия относительно нарезки по 25 сек без VAD
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS audio_seconds        REAL;
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS billed_seconds       INTEGER;
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS billed_seconds_saved INTEGER;
+
+-- 3. Кэш транскриптов по хешу содержимого файла
+--    Та же запись под другим именем (копия, повторный экспорт Jibri) не отправляется
+--    провайдеру повторно. pcm_hash — отпечаток декодированного звука (AUDIO_FINGERPRINT=1)
+CREATE TABLE IF NOT EXISTS transcript_cache (
+    content_hash    VARCHAR(64) PRIMARY KEY,
+    pcm_hash        VARCHAR(64),
+    transcript_text TEXT NOT NULL,
+    provider        VARCHAR(50),
+    hits            INTEGER NOT NULL DEFAULT 0,
+    created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_hit_at     TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_transcript_cache_pcm_hash
+    ON transcript_cache(pcm_hash)
+    WHERE pcm_hash IS NOT NULL;
+
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);
+CREATE INDEX IF NOT EXISTS idx_processed_files_content_hash ON processed_files(content_hash);
+
+-- 4. callback_url: куда POST'ить результат по завершении задачи (напр. resume-URL n8n Wait)
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS callback_url VARCHAR(1000);
+
+-- 5. AssemblyAI webhook: status awaiting_provider — задача отправлена провайдеру,
+--    воркер свободен, transcript_id в operation_id; завершается по webhook
+--    или сверкой опросом (ASSEMBLYAI_WEBHOOK_CHECK_SEC)
+CREATE INDEX IF NOT EXISTS idx_processed_files_awaiting
+    ON processed_files(updated_at)
+    WHERE status = 'awaiting_provider';
+
+-- 6. Какой провайдер выдал транскрипт (маршрутизация STT_ROUTES, hedging)
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS stt_provider VARCHAR(50);
+
+-- 7. Circuit breaker: провайдер недоступен — задача снова queued, но не раньше retry_at
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS retry_at TIMESTAMPTZ;
+
+-- 8. Чекпоинты чанков SpeechKit: после рестарта распознаются только недостающие чанки.
+--    plan_id — идентификатор нарезки (VAD-план или фиксированные чанки);
+--    строки удаляются, когда транскрипт собран. progress — % распознанных чанков для /check
+CREATE TABLE IF NOT EXISTS transcript_chunks (
+    content_hash VARCHAR(64) NOT NULL,
+    plan_id      VARCHAR(64) NOT NULL,
+    chunk_index  INTEGER     NOT NULL,
+    start_sec    REAL,
+    end_sec      REAL,
+    text         TEXT        NOT NULL,
+    provider     VARCHAR(50),
+    created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (content_hash, plan_id, chunk_index)
+);
+
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS progress REAL;
+
+-- 9. Сегменты транскрипта с таймингами (start, end, speaker, text) — колоночный JSONB:
+--    {"start": [...], "end": [...], "speaker": [...], "text": [...]}; срезы записи — POST /segments
+ALTER TABLE processed_files  ADD COLUMN IF NOT EXISTS transcript_segments JSONB;
+ALTER TABLE transcript_cache ADD COLUMN IF NOT EXISTS segments            JSONB;
+
+-- 10. Манифест /recordings для сверки watcher (POST /ingest): файлы — path, размер, mtime,
+--     хеш содержимого (заполняет задача транскрибации); каталоги — mtime на момент просмотра.
+--     Сверка перечисляет только каталоги, чей mtime изменился, — время пропорционально изменениям
+CREATE TABLE IF NOT EXISTS recordings_manifest (
+    path         VARCHAR(1000) PRIMARY KEY,
+    size_bytes   BIGINT,
+    mtime        DOUBLE PRECISION,
+    content_hash VARCHAR(64),
+    seen_at      TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS recordings_dirs (
+    path       VARCHAR(1000) PRIMARY KEY,
+    mtime      DOUBLE PRECISION NOT NULL,
+    scanned_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- 11. Планировщик очереди: sched_at — место в очереди. Свежие записи (file_date за последние
+--     QUEUE_FRESH_DAYS дней) ставятся на QUEUE_FRESH_BOOST_SEC раньше queued_at — впереди бэкфилла,
+--     но задача из бэкфилла, прождавшая дольше буста, обгоняет и свежие (aging, без голодания).
+ALTER TABLE processed_files ADD COLUMN IF NOT EXISTS sched_at TIMESTAMPTZ;
+UPDATE processed_files SET sched_at = COALESCE(queued_at, created_at)
+    WHERE sched_at IS NULL AND status IN ('queued', 'transcribing');
+
+DROP INDEX IF EXISTS idx_processed_files_queue;
+CREATE INDEX IF NOT EXISTS idx_processed_files_sched
+    ON processed_files(priority DESC, sched_at, id)
+    WHERE status = 'queued';
+
+-- 12. Строки, оставленные в transcribing синхронным WF01 (до v3): аренды у них нет,
+--     requeue_expired их не видит, а WF01 больше не вызывает POST / — возвращаем в очередь
+UPDATE processed_files
+    SET status = 'queued',
+        queued_at = COALESCE(queued_at, created_at),
+        sched_at = COALESCE(sched_at, queued_at, created_at)
+    WHERE status = 'transcribing' AND lease_expires_at IS NULL;
+
+SELECT 'Migration v3 completed' AS result;
@@ -1,265 +1,343 @@
 #!/usr/bin/env python3
 """
-Транскрибация аудио/видео файлов через Яндекс SpeechKit.
-Использует асинхронное распознавание (для файлов > 1 минуты).
+Пакетная транскрибация архива записей движком transcribe-сервиса.
+
+Провайдеры, маршрутизация (STT_ROUTES), VAD-нарезка и параллельные чанки SpeechKit,
+circuit breaker'ы, кэш транскриптов и чекпоинты чанков — из
+services/transcribe/transcribe_server.py (импортируется как модуль, HTTP-сервер
+и очередь processed_files не запускаются). Настройки движка — те же ENV, что у сервиса
+(SPEECHKIT_CONCURRENCY, FFMPEG_CONCURRENCY, VAD_*, POSTGRES_* …).
+
+Файлы идут в --workers параллельных задач, крупные — первыми (короче хвост прогона).
+Результат — <имя>_transcript.txt рядом с исходником (или в --out-dir), с --segments —
+ещё <имя>_segments.json. Каждый завершённый файл дописывается строкой в манифест
+(JSONL): --resume пропускает файлы, уже обработанные с тем же размером и mtime.
+Кэш транскриптов (transcript_cache) и чекпоинты чанков работают, если доступна БД
+сервиса; без БД — только провайдер. --provider заменяет и STT_PROVIDER, и STT_ROUTES.
 
 Использование:
   python transcribe_speechkit.py --key AQVN... --file /path/to/file.webm
-  python transcribe_speechkit.py --key AQVN... --dir /mnt/recordings/2026/02/20
+  python transcribe_speechkit.py --key AQVN... --dir /mnt/recordings/2026/02 --recursive --workers 8
+  python transcribe_speechkit.py --dir /mnt/recordings --recursive --resume --manifest backfill.jsonl
+  STT_ROUTES=speechkit:300,whisper python transcribe_speechkit.py --dir /mnt/recordings -r --workers 4
+  python transcribe_speechkit.py --key AQVN... --test
 
-Результат сохраняется в .txt рядом с исходным файлом.
+Код выхода 1 — есть файлы с ошибкой (повторный запуск с --resume возьмёт только их).
 """
 
 import argparse
+import asyncio
+import json
 import os
 import sys
+import threading
 import time
-import json
-import subprocess
-import tempfile
-import urllib.request
 import urllib.error
+import urllib.request
 
-# ── Яндекс SpeechKit ──────────────────────────────────────────────────────────
-SPEECHKIT_UPLOAD_URL = "https://storage.yandexcloud.net"
-SPEECHKIT_ASR_URL = "https://transcribe.api.cloud.yandex.net/speech/stt/v2/longRunningRecognize"
-SPEECHKIT_OP_URL = "https://operation.api.cloud.yandex.net/operations/{op_id}"
+ENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'services', 'transcribe')
 
 # Поддерживаемые форматы
 AUDIO_EXTS = {'.webm', '.mp3', '.ogg', '.wav', '.mp4', '.m4a', '.flac'}
-MAX_SIZE_BYTES = 100 * 1024 * 1024  # 100 MB
 
 
 def log(msg):
     print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
 
 
-def convert_to_ogg(input_path: str) -> str:
-    """Конвертирует файл в OGG Opus через ffmpeg. Возвращает путь к tmp файлу."""
-    tmp = tempfile.mktemp(suffix='.ogg')
-    cmd = [
-        'ffmpeg', '-i', input_path,
-        '-vn',                    # без видео
-        '-acodec', 'libopus',
-        '-b:a', '64k',            # 64kbps достаточно для речи
-        '-ac', '1',               # моно
-        '-ar', '16000',           # 16kHz — оптимально для SpeechKit
-        tmp, '-y'
-    ]
-    result = subprocess.run(cmd, capture_output=True, timeout=300)
-    if result.returncode != 0:
-        raise RuntimeError(f"ffmpeg error: {result.stderr.decode(errors='replace')[-500:]}")
-    log(f"Конвертировано: {os.path.basename(input_path)} → {os.path.getsize(tmp) // 1024}KB OGG")
-    return tmp
-
-
-def upload_to_s3(file_path: str, api_key: str, bucket: str = "speechkit-tmp") -> str:
-    """
-    Загружает файл в Яндекс Object Storage.
-    Возвращает публичный URI.
-    
-    ВАЖНО: для этого нужен отдельный bucket. Если нет — используем inline base64 (только для файлов < 1MB).
-    Для больших файлов — загружаем через boto3/aws-cli.
-    """
-    raise NotImplementedError(
-        "Загрузка в S3 требует настройки Yandex Object Storage bucket.\n"
-        "Используйте --local режим (Whisper на сервере) или настройте bucket."
-    )
-
+def fmt_duration(sec):
+    sec = int(sec)
+    if sec >= 3600:
+        return f'{sec // 3600}h{sec % 3600 // 60:02d}m'
+    return f'{sec // 60}m{sec % 60:02d}s'
 
-def transcribe_inline(audio_path: str, api_key: str) -> str:
-    """
-    Синхронная транскрипция через SpeechKit (файл < 1MB, < 30 сек).
-    Отправляет файл напрямую в теле запроса.
-    """
-    with open(audio_path, 'rb') as f:
-        audio_data = f.read()
 
-    url = "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize?lang=ru-RU&format=oggopus&sampleRateHertz=16000"
-    req = urllib.request.Request(
-        url,
-        data=audio_data,
-        headers={
-            'Authorization': f'Api-Key {api_key}',
-            'Content-Type': 'application/octet-stream',
-        },
-        method='POST'
-    )
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        result = json.loads(resp.read())
-    return result.get('result', '')
+def load_engine(args):
+    """Импорт transcribe_server с настройками из аргументов (ENV читается при импорте)."""
+    if args.key:
+        os.environ['YANDEX_API_KEY'] = args.key
+    if args.provider:
+        # --provider сильнее STT_ROUTES из окружения: весь прогон — одним провайдером
+        os.environ['STT_PROVIDER'] = args.provider
+        os.environ['STT_ROUTES'] = ''
+    if args.no_cache:
+        os.environ['TRANSCRIPT_CACHE'] = '0'
+    os.environ.setdefault('LOG_FILE', '')
+    sys.path.insert(0, os.path.abspath(ENGINE_DIR))
+    import transcribe_server
+    return transcribe_server
 
 
-def transcribe_async(audio_uri: str, api_key: str) -> str:
+def collect_files(args):
+    if args.file:
+        return [os.path.abspath(args.file)]
+    files = []
+    for root, dirs, names in os.walk(args.dir):
+        dirs.sort()
+        files += [os.path.join(root, n) for n in names if os.path.splitext(n)[1].lower() in AUDIO_EXTS]
+        if not args.recursive:
+            break
+    return sorted(os.path.abspath(f) for f in files)
+
+
+def load_manifest(path):
+    """Последняя запись манифеста по каждому файлу; битая строка (прерванная запись) пропускается."""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                records[rec['path']] = rec
+            except (ValueError, KeyError, TypeError):
+                continue
+    return records
+
+
+def output_paths(args, filepath):
+    """(транскрипт, сегменты): рядом с исходником или в --out-dir с сохранением структуры --dir."""
+    stem = os.path.splitext(filepath)[0]
+    if args.out_dir:
+        base = args.dir or os.path.dirname(filepath)
+        stem = os.path.join(args.out_dir, os.path.relpath(stem, os.path.abspath(base)))
+    return stem + '_transcript.txt', stem + '_segments.json'
+
+
+class BatchRun:
     """
-    Асинхронная транскрипция для длинных файлов через SpeechKit Long Running.
-    audio_uri — публичный URL файла в Yandex Object Storage.
+    Параллельная обработка списка файлов на RUNNER движка: --workers корутин
+    берут файлы из общей очереди. Счётчики — для отчёта о прогрессе.
     """
-    payload = {
-        "config": {
-            "specification": {
-                "languageCode": "ru-RU",
-                "audioEncoding": "OGG_OPUS",
-                "sampleRateHertz": 16000,
-                "audioChannelCount": 1,
-            }
-        },
-        "audio": {
-            "uri": audio_uri
-        }
-    }
-    data = json.dumps(payload).encode('utf-8')
+
+    def __init__(self, ts, args, files, manifest_path, use_db):
+        self.ts = ts
+        self.args = args
+        self.files = files
+        self.manifest_path = manifest_path
+        self.use_db = use_db
+        self.total_bytes = sum(size for _, size in files)
+        self.done = 0
+        self.done_bytes = 0
+        self.cached = 0
+        self.errors = 0
+        self.audio_sec = 0.0
+        self.providers = {}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write_outputs(self, filepath, text, segments):
+        txt_path, seg_path = output_paths(self.args, filepath)
+        os.makedirs(os.path.dirname(txt_path), exist_ok=True)
+        with open(txt_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if self.args.segments:
+            with open(seg_path, 'w', encoding='utf-8') as f:
+                json.dump(segments, f, ensure_ascii=False)
+        return txt_path
+
+    def record(self, rec):
+        """Строка в манифест — сразу после файла, чтобы прерванный прогон продолжился с --resume."""
+        with open(self.manifest_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+
+    async def transcribe(self, filepath, name):
+        """
+        (provider, text, segments): кэш по хешу содержимого, при промахе — transcribe_routed.
+        Задача не из processed_files (tracked=False): движок не пишет служебные колонки.
+        """
+        ts = self.ts
+        content_hash = pcm_hash = None
+        if self.use_db:
+            with ts.STAGES.timer('hash'):
+                content_hash = await ts.blocking(ts.file_sha256, filepath)
+        if content_hash and ts.TRANSCRIPT_CACHE:
+            pcm_hash = await ts.pcm_fingerprint(filepath) if ts.AUDIO_FINGERPRINT else None
+            cached = await ts.blocking(ts.cache_lookup, content_hash, pcm_hash)
+            ts.CACHE_STATS.record(cached is not None)
+            if cached is not None:
+                text, columns = cached
+                return 'cache', text, ts.unpack_segments(columns)
+
+        provider, (text, segments) = await ts.transcribe_routed(filepath, name, content_hash, tracked=False)
+        if ts.needs_diarization(provider, segments):
+            try:
+                with ts.STAGES.timer('diarize'):
+                    segments = await ts.diarize_segments(filepath, segments)
+            except Exception as e:
+                ts.log(f'DIARIZATION ERR: {name}: {e}')
+        if content_hash:
+            await ts.blocking(ts.clear_chunks, content_hash)
+            if text and ts.TRANSCRIPT_CACHE:
+                await ts.blocking(ts.cache_store, content_hash, pcm_hash, text, segments, provider)
+        return provider, text, segments
+
+    async def process(self, filepath, size):
+        ts = self.ts
+        name = os.path.relpath(filepath, self.args.dir) if self.args.dir else os.path.basename(filepath)
+        stat = os.stat(filepath)
+        rec = {'path': filepath, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        start = time.monotonic()
+        audio_sec = None
+        try:
+            audio_sec = await ts.probe_duration(filepath)
+            provider, text, segments = await self.transcribe(filepath, name)
+            txt_path = await ts.blocking(self.write_outputs, filepath, text, segments)
+            rec.update(status='done', provider=provider, output=txt_path, chars=len(text))
+            ts.log(f'DONE: {name} -> {len(text)} chars, {len(segments)} segments ({provider})')
+        except ts.ProviderUnavailable as e:
+            rec.update(status='error', error=f'provider unavailable: {e}')
+            ts.log(f'BACKOFF: {name}: {e}')
+        except Exception as e:
+            rec.update(status='error', error=str(e) or repr(e))
+            ts.log(f'ERR: {name}: {rec["error"]}')
+        rec.update(audio_sec=audio_sec, sec=round(time.monotonic() - start, 2), at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        await ts.blocking(self.record, rec)
+        with self._lock:
+            self.done += 1
+            self.done_bytes += size
+            self.audio_sec += audio_sec or 0
+            if rec['status'] == 'error':
+                self.errors += 1
+            else:
+                self.cached += rec['provider'] == 'cache'
+                self.providers[rec['provider']] = self.providers.get(rec['provider'], 0) + 1
+
+    async def run(self):
+        pending = iter(self.files)  # общий итератор: воркер берёт следующий файл, как освободится
+
+        async def worker():
+            for filepath, size in pending:
+                await self.process(filepath, size)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.args.workers, len(self.files)))))
+
+    def report(self, final=False):
+        """Прогресс: файлы, часы аудио, пропускная способность и ETA (по объёму оставшихся файлов)."""
+        with self._lock:
+            done, done_bytes, audio_sec = self.done, self.done_bytes, self.audio_sec
+            cached, errors, providers = self.cached, self.errors, dict(self.providers)
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        line = (f'{done}/{len(self.files)} files ({cached} cached, {errors} errors), '
+                f'audio {audio_sec / 3600:.2f} h in {fmt_duration(elapsed)}: '
+                f'{done / elapsed * 3600:.0f} files/h, {audio_sec / elapsed:.1f}x realtime')
+        if final:
+            by_provider = ', '.join(f'{p}={n}' for p, n in sorted(providers.items())) or '-'
+            self.ts.log(f'TOTAL: {line}; providers: {by_provider}')
+            return
+        if done_bytes:
+            eta = (self.total_bytes - done_bytes) * elapsed / done_bytes
+            line += f', ETA {fmt_duration(eta)}'
+        self.ts.log(f'PROGRESS: {line}')
+
+
+def check_key(api_key, url):
+    log("Тестируем SpeechKit API...")
     req = urllib.request.Request(
-        SPEECHKIT_ASR_URL,
-        data=data,
-        headers={
-            'Authorization': f'Api-Key {api_key}',
-            'Content-Type': 'application/json',
-        },
+        url + '?lang=ru-RU',
+        data=b'\x00' * 100,
+        headers={'Authorization': f'Api-Key {api_key}'},
         method='POST'
     )
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        op = json.loads(resp.read())
-
-    op_id = op.get('id')
-    if not op_id:
-        raise RuntimeError(f"No operation ID: {op}")
-
-    log(f"Операция запущена: {op_id}")
-
-    # Поллинг статуса
-    for attempt in range(120):  # ждём до 20 минут
-        time.sleep(10)
-        op_req = urllib.request.Request(
-            SPEECHKIT_OP_URL.format(op_id=op_id),
-            headers={'Authorization': f'Api-Key {api_key}'},
-        )
-        with urllib.request.urlopen(op_req, timeout=15) as resp:
-            status = json.loads(resp.read())
-
-        if status.get('done'):
-            if 'error' in status:
-                raise RuntimeError(f"SpeechKit error: {status['error']}")
-            chunks = status.get('response', {}).get('chunks', [])
-            text = ' '.join(
-                alt.get('text', '')
-                for chunk in chunks
-                for alt in chunk.get('alternatives', [])[:1]
-            )
-            return text.strip()
-
-        if attempt % 6 == 0:
-            log(f"  Ждём результат... ({attempt * 10}s)")
-
-    raise TimeoutError("SpeechKit не ответил за 20 минут")
-
-
-def transcribe_file(input_path: str, api_key: str) -> str:
-    """Основная функция: конвертирует и транскрибирует файл."""
-    size = os.path.getsize(input_path)
-    log(f"Файл: {os.path.basename(input_path)} ({size // 1024 // 1024}MB)")
-
-    if size > MAX_SIZE_BYTES:
-        log(f"ПРОПУСК: файл > 100MB")
-        return None
-
-    # Конвертируем в OGG
-    tmp_ogg = None
     try:
-        tmp_ogg = convert_to_ogg(input_path)
-        ogg_size = os.path.getsize(tmp_ogg)
-
-        if ogg_size < 900_000:
-            # Маленький файл — синхронная транскрипция
-            log("Режим: синхронный (inline)")
-            text = transcribe_inline(tmp_ogg, api_key)
+        urllib.request.urlopen(req, timeout=10)
+    except urllib.error.HTTPError as e:
+        if e.code in (400, 415):
+            log(f"API отвечает (ошибка {e.code} ожидаема для пустых данных) — КЛЮЧ РАБОЧИЙ")
+        elif e.code == 401:
+            log("ОШИБКА 401: неверный API ключ")
         else:
-            # Большой файл — нужна загрузка в S3
-            log(f"Размер OGG: {ogg_size // 1024}KB — нужен Object Storage")
-            raise NotImplementedError(
-                "Файл слишком большой для inline. Нужен Yandex Object Storage bucket.\n"
-                "Создайте bucket и передайте --bucket параметр."
-            )
-
-        return text
-
-    finally:
-        if tmp_ogg and os.path.exists(tmp_ogg):
-            os.unlink(tmp_ogg)
-
+            log(f"HTTP {e.code}: {e.read().decode(errors='replace')[:200]}")
 
-def process_file(input_path: str, api_key: str) -> bool:
-    """Обрабатывает один файл, сохраняет .txt результат."""
-    output_path = os.path.splitext(input_path)[0] + '_transcript.txt'
-
-    if os.path.exists(output_path):
-        log(f"УЖЕ ОБРАБОТАН: {output_path}")
-        return True
 
+def db_available(ts):
     try:
-        text = transcribe_file(input_path, api_key)
-        if text is None:
-            return False
-        if not text:
-            log("ПРЕДУПРЕЖДЕНИЕ: пустой текст транскрипции")
-
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(text)
-        log(f"СОХРАНЕНО: {output_path}")
-        log(f"Превью: {text[:200]}...")
+        with ts.db_cursor() as cur:
+            cur.execute('SELECT 1 FROM transcript_cache, transcript_chunks LIMIT 0')
         return True
-
-    except NotImplementedError as e:
-        log(f"ОШИБКА (нужна настройка): {e}")
-        return False
     except Exception as e:
-        log(f"ОШИБКА: {e}")
+        ts.log(f"DB unavailable, transcript cache and chunk checkpoints off: "
+               f"{str(e).strip().splitlines()[0] if str(e).strip() else repr(e)}")
         return False
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Транскрибация через Яндекс SpeechKit')
-    parser.add_argument('--key', required=True, help='API ключ SpeechKit (начинается с AQVN...)')
+    parser = argparse.ArgumentParser(description='Пакетная транскрибация движком transcribe-сервиса')
+    parser.add_argument('--key', help='API ключ SpeechKit (начинается с AQVN...; иначе YANDEX_API_KEY)')
+    parser.add_argument('--provider', help='Провайдер прогона (speechkit|whisper|local_whisper|assemblyai); '
+                                           'заменяет STT_PROVIDER и STT_ROUTES')
     parser.add_argument('--file', help='Путь к одному файлу')
     parser.add_argument('--dir', help='Директория с файлами (обрабатывает все аудио/видео)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='Обходить поддиректории --dir')
+    parser.add_argument('--workers', type=int, default=4, help='Файлов в работе одновременно (по умолчанию 4)')
+    parser.add_argument('--manifest', help='Манифест прогона, JSONL (по умолчанию transcribe_manifest.jsonl в --dir)')
+    parser.add_argument('--resume', action='store_true', help='Пропустить файлы, обработанные по манифесту')
+    parser.add_argument('--out-dir', help='Куда писать транскрипты (структура --dir сохраняется); по умолчанию — рядом')
+    parser.add_argument('--segments', action='store_true', help='Сохранять сегменты с таймингами (_segments.json)')
+    parser.add_argument('--overwrite', action='store_true', help='Перезаписывать существующие _transcript.txt')
+    parser.add_argument('--no-cache', action='store_true', help='Не использовать transcript_cache')
+    parser.add_argument('--progress-sec', type=float, default=30, help='Период отчёта о прогрессе, сек')
     parser.add_argument('--test', action='store_true', help='Тест соединения с SpeechKit')
     args = parser.parse_args()
 
-    if args.test:
-        log("Тестируем SpeechKit API...")
-        req = urllib.request.Request(
-            "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize?lang=ru-RU",
-            data=b'\x00' * 100,
-            headers={'Authorization': f'Api-Key {args.key}'},
-            method='POST'
-        )
-        try:
-            urllib.request.urlopen(req, timeout=10)
-        except urllib.error.HTTPError as e:
-            if e.code in (400, 415):
-                log(f"API отвечает (ошибка {e.code} ожидаема для пустых данных) — КЛЮЧ РАБОЧИЙ")
-            elif e.code == 401:
-                log(f"ОШИБКА 401: неверный API ключ")
-            else:
-                log(f"HTTP {e.code}: {e.read().decode(errors='replace')[:200]}")
-        return
-
-    if args.file:
-        process_file(args.file, args.key)
-
-    elif args.dir:
-        files = [
-            os.path.join(args.dir, f)
-            for f in sorted(os.listdir(args.dir))
-            if os.path.splitext(f)[1].lower() in AUDIO_EXTS
-        ]
-        log(f"Найдено файлов: {len(files)}")
-        for f in files:
-            process_file(f, args.key)
-
-    else:
+    if not (args.test or args.file or args.dir):
         parser.print_help()
+        return 0
+
+    ts = load_engine(args)
+    if args.test:
+        check_key(ts.YANDEX_API_KEY, ts.SPEECHKIT_URL)
+        return 0
+
+    if args.file and not os.path.isfile(args.file):
+        parser.error(f'файл не найден: {args.file}')
+    files = collect_files(args)
+    manifest_path = args.manifest or os.path.join(args.dir or os.path.dirname(files[0]), 'transcribe_manifest.jsonl')
+    done = load_manifest(manifest_path) if args.resume else {}
+    todo, skipped = [], 0
+    for filepath in files:
+        stat = os.stat(filepath)
+        rec = done.get(filepath)
+        if rec and rec.get('status') == 'done' and rec.get('size') == stat.st_size and rec.get('mtime') == stat.st_mtime:
+            skipped += 1
+            continue
+        txt_path, _ = output_paths(args, filepath)
+        if not args.overwrite and os.path.exists(txt_path):
+            skipped += 1
+            continue
+        todo.append((filepath, stat.st_size))
+    # Крупные файлы — первыми: последние задачи прогона короткие, воркеры не простаивают в хвосте
+    todo.sort(key=lambda item: -item[1])
+
+    ts.LOG_LISTENER.start()
+    ts.log(f"BATCH: {len(files)} files, {len(todo)} to do ({sum(s for _, s in todo) / 1e9:.2f} GB), "
+           f"{skipped} already done; routes={ts.STT_ROUTES}, workers={args.workers}, manifest={manifest_path}")
+    if not todo:
+        ts.LOG_LISTENER.stop()
+        return 0
+
+    ts.RUNNER.start()
+    if any(name == 'local_whisper' for name, _ in ts.STT_ROUTES):
+        ts.LOCAL_WHISPER.load()
+    batch = BatchRun(ts, args, todo, manifest_path, db_available(ts))
+    future = ts.RUNNER.submit(batch.run())
+    try:
+        while True:
+            try:
+                future.result(timeout=args.progress_sec)
+                break
+            except TimeoutError:
+                batch.report()
+        batch.report(final=True)
+        return 1 if batch.errors else 0
+    except KeyboardInterrupt:
+        future.cancel()
+        batch.report(final=True)
+        ts.log('INTERRUPTED: finished files are in the manifest, continue with --resume')
+        return 130
+    finally:
+        ts.LOG_LISTENER.stop()  # дописать очередь лога до выхода
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
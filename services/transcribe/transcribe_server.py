@@ -1,305 +1,2771 @@
 #!/usr/bin/env python3
 """
 Transcription Server — универсальный адаптер STT.
-Переключение провайдера через ENV: STT_PROVIDER=speechkit|whisper|assemblyai
+Переключение провайдера через ENV: STT_PROVIDER=speechkit|whisper|local_whisper|assemblyai,
+или выбор на задачу из нескольких: STT_ROUTES=speechkit:300,whisper
 
 API:
-  POST /          — запустить транскрипцию { filepath, filename }
-  POST /check     — проверить результат { filename }
-  GET  /health    — статус сервиса
+  POST /          — поставить файл в очередь { filepath, filename, priority? }
+  POST /ingest    — пачка обнаруженных файлов { files: [{filepath, size?, mtime?}], dirs? } → только новые
+  GET  /manifest/dirs — mtime каталогов /recordings на момент последней сверки watcher
+  POST /check     — проверить результат { filename, wait? } (wait — long-poll, сек)
+  POST /segments  — сегменты с таймингами { filename, from?, to?, speaker? }
+  GET  /health    — статус сервиса (провайдер, воркеры, кэш, пул БД)
+  GET  /livez     — liveness для Docker healthcheck: без БД и блокировок
+  GET  /metrics   — метрики в текстовом формате Prometheus
+  POST /webhooks/assemblyai?filename=… — завершение задачи AssemblyAI (webhook_url)
+
+Очередь задач хранится в processed_files (status=queued, см. scripts/migrate_db_v3.sql).
+Задачи в работе (до TRANSCRIBE_WORKERS) — корутины на одном event loop: ожидание
+провайдера не держит поток, ffmpeg — до FFMPEG_CONCURRENCY процессов, БД и хеширование —
+в пуле потоков. Задача арендуется (lease), аренда продлевается heartbeat'ом;
+просроченные аренды возвращаются в очередь.
+По завершении задачи сервер POST'ит результат на callback_url (если передан в POST /).
 """
 
-import json, os, shutil, subprocess, tempfile, time, urllib.request, threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import asyncio, collections, functools, hashlib, json, math, os, queue, random, re, shutil, signal, socket, sys, tempfile, time, urllib.parse, uuid, threading
+import logging, logging.handlers
+from asyncio.subprocess import DEVNULL, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import httpx
 import psycopg2
+import psycopg2.pool
 
 # ── Конфигурация ─────────────────────────────────────────────────────────────────────────────
 
 PORT = int(os.getenv('TRANSCRIBE_PORT', '9001'))
+# HTTP/1.1 keep-alive: таймаут чтения запроса и простоя соединения; лимит тела запроса
+HTTP_REQUEST_TIMEOUT_SEC = float(os.getenv('HTTP_REQUEST_TIMEOUT_SEC', '30'))
+HTTP_MAX_BODY_BYTES = int(os.getenv('HTTP_MAX_BODY_BYTES', str(1024 * 1024)))
 
-# Активный провайдер: speechkit | whisper | assemblyai
+# Активный провайдер: speechkit | whisper | local_whisper | assemblyai
 STT_PROVIDER = os.getenv('STT_PROVIDER', 'speechkit').lower().strip()
+# Маршрутизация на задачу: "provider[:max_sec],..." — провайдер берёт файлы не длиннее max_sec,
+# из подходящих выбирается с наименьшим ожидаемым временем (p95 × длительность × очередь).
+# Пусто — всегда STT_PROVIDER. Пример: speechkit:300,whisper — короткие в SpeechKit, длинные в Whisper
+STT_ROUTES = [
+    (name, float(max_sec) if max_sec else None)
+    for name, _, max_sec in (r.strip().lower().partition(':') for r in os.getenv('STT_ROUTES', '').split(','))
+    if name
+] or [(STT_PROVIDER, None)]
+# Hedging: первый провайдер не уложился в STT_HEDGE_FACTOR × ожидаемое время —
+# параллельно запускается следующий кандидат, берётся первый успешный ответ
+STT_HEDGE = os.getenv('STT_HEDGE', '0') == '1'
+STT_HEDGE_FACTOR = float(os.getenv('STT_HEDGE_FACTOR', '1.5'))
+# Circuit breaker на провайдера: доля ошибок (429/5xx/сеть) за BREAKER_WINDOW_SEC не меньше
+# BREAKER_ERROR_RATE при BREAKER_MIN_CALLS+ вызовах → open на BREAKER_OPEN_SEC, затем
+# half-open: BREAKER_HALF_OPEN_CALLS пробных вызовов решают, закрыться или открыться снова
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', '0.5'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '10'))
+BREAKER_WINDOW_SEC = float(os.getenv('BREAKER_WINDOW_SEC', '60'))
+BREAKER_OPEN_SEC = float(os.getenv('BREAKER_OPEN_SEC', '30'))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv('BREAKER_HALF_OPEN_CALLS', '3'))
 
 # SpeechKit (Yandex)
 YANDEX_API_KEY = os.getenv('YANDEX_API_KEY', '')
+SPEECHKIT_URL = os.getenv('SPEECHKIT_URL', 'https://stt.api.cloud.yandex.net/speech/v1/stt:recognize')
+# Параллельная отправка чанков: общий пул на все задачи + лимит запросов/сек (квота провайдера)
+SPEECHKIT_CONCURRENCY = int(os.getenv('SPEECHKIT_CONCURRENCY', '8'))
+SPEECHKIT_RPS = float(os.getenv('SPEECHKIT_RPS', '20'))
+SPEECHKIT_RETRIES = int(os.getenv('SPEECHKIT_RETRIES', '4'))
+SPEECHKIT_CHUNK_SEC = int(os.getenv('SPEECHKIT_CHUNK_SEC', '25'))
+# С VAD чанки собираются из участков речи до этого предела (sync API: до 30 сек)
+SPEECHKIT_MAX_CHUNK_SEC = float(os.getenv('SPEECHKIT_MAX_CHUNK_SEC', '29.5'))
+SPEECHKIT_BILLING_SEC = 15  # тарификация: каждые 15 сек, округление вверх
+# Доля чанков, которые могут не распознаться (после retry); больше — задача с ошибкой,
+# а не транскрипт с дырами
+SPEECHKIT_MAX_FAILED_CHUNKS = float(os.getenv('SPEECHKIT_MAX_FAILED_CHUNKS', '0.05'))
+
+# VAD (ffmpeg silencedetect): паузы длиннее VAD_MIN_SILENCE_SEC тише VAD_NOISE_DB
+# вырезаются, вокруг речи остаётся VAD_PAD_SEC
+VAD_ENABLED = os.getenv('VAD_ENABLED', '1') == '1'
+VAD_NOISE_DB = float(os.getenv('VAD_NOISE_DB', '-35'))
+VAD_MIN_SILENCE_SEC = float(os.getenv('VAD_MIN_SILENCE_SEC', '0.6'))
+VAD_PAD_SEC = float(os.getenv('VAD_PAD_SEC', '0.2'))
+
+# ffmpeg: предел на один проход transcode + segment; одновременно не больше
+# FFMPEG_CONCURRENCY процессов (CPU) — ожидание ответа провайдера слот не занимает
+FFMPEG_TIMEOUT_SEC = int(os.getenv('FFMPEG_TIMEOUT_SEC', '600'))
+FFMPEG_CONCURRENCY = int(os.getenv('FFMPEG_CONCURRENCY', str(max(1, (os.cpu_count() or 2) // 2))))
+
+# Перекодирование в 16 kHz моно Opus перед загрузкой (Whisper/AssemblyAI):
+# для каких провайдеров и начиная с какого размера файла это окупается
+PRETRANSCODE_PROVIDERS = {
+    p.strip() for p in os.getenv('PRETRANSCODE_PROVIDERS', 'whisper,assemblyai').lower().split(',') if p.strip()
+}
+PRETRANSCODE_MIN_BYTES = int(os.getenv('PRETRANSCODE_MIN_BYTES', str(2 * 1024 * 1024)))
+
+# Whisper self-hosted (faster-whisper HTTP API, напр. http://whisper:9000)
+WHISPER_URL = os.getenv('WHISPER_URL', 'http://whisper:9000')
+# Сколько файлов Whisper реально обрабатывает параллельно (для оценки очереди при маршрутизации)
+WHISPER_CAPACITY = int(os.getenv('WHISPER_CAPACITY', '1'))
+# Повторы запроса при 429, 5xx и сетевых ошибках / таймауте (with_retries)
+WHISPER_RETRIES = int(os.getenv('WHISPER_RETRIES', '2'))
+
+# local_whisper: faster-whisper (CTranslate2) внутри сервиса, CPU int8. Модель грузится
+# один раз при старте; WORKERS файлов распознаются параллельно на общих весах,
+# у каждого — THREADS потоков; BATCH — VAD-сегментов файла за один проход модели
+LOCAL_WHISPER_MODEL = os.getenv('LOCAL_WHISPER_MODEL', 'medium')
+LOCAL_WHISPER_COMPUTE_TYPE = os.getenv('LOCAL_WHISPER_COMPUTE_TYPE', 'int8')
+LOCAL_WHISPER_WORKERS = int(os.getenv('LOCAL_WHISPER_WORKERS', '1'))
+LOCAL_WHISPER_THREADS = int(os.getenv('LOCAL_WHISPER_THREADS', str(max(1, (os.cpu_count() or 2) // LOCAL_WHISPER_WORKERS))))
+LOCAL_WHISPER_BATCH = int(os.getenv('LOCAL_WHISPER_BATCH', '8'))
+LOCAL_WHISPER_MODEL_DIR = os.getenv('LOCAL_WHISPER_MODEL_DIR', '') or None
+
+# AssemblyAI
+ASSEMBLYAI_API_KEY = os.getenv('ASSEMBLYAI_API_KEY', '')
+ASSEMBLYAI_BASE_URL = os.getenv('ASSEMBLYAI_BASE_URL', 'https://api.assemblyai.com').rstrip('/')
+ASSEMBLYAI_UPLOAD_URL = ASSEMBLYAI_BASE_URL + '/v2/upload'
+ASSEMBLYAI_TRANSCRIPT_URL = ASSEMBLYAI_BASE_URL + '/v2/transcript'
+# Адаптивный polling: ожидаемое время обработки ≈ ASSEMBLYAI_RTF × длительность записи
+ASSEMBLYAI_RTF = float(os.getenv('ASSEMBLYAI_RTF', '0.3'))
+ASSEMBLYAI_POLL_MAX_SEC = float(os.getenv('ASSEMBLYAI_POLL_MAX_SEC', '60'))
+# Повторы upload / submit / опроса при 429, 5xx и сетевых ошибках (with_retries)
+ASSEMBLYAI_RETRIES = int(os.getenv('ASSEMBLYAI_RETRIES', '4'))
+# Webhook: внешний адрес этого сервиса. Задан — воркер не ждёт AssemblyAI,
+# задача переходит в awaiting_provider и завершается по POST /webhooks/assemblyai.
+# С webhook секрет обязателен: без него сервис не стартует
+ASSEMBLYAI_WEBHOOK_BASE_URL = os.getenv('ASSEMBLYAI_WEBHOOK_BASE_URL', '').rstrip('/')
+ASSEMBLYAI_WEBHOOK_SECRET = os.getenv('ASSEMBLYAI_WEBHOOK_SECRET', '')
+# awaiting_provider без webhook дольше этого — сверяем статус опросом
+ASSEMBLYAI_WEBHOOK_CHECK_SEC = int(os.getenv('ASSEMBLYAI_WEBHOOK_CHECK_SEC', '600'))
+
+# Очередь задач: сколько задач одновременно в работе (корутины на event loop) + аренда (lease)
+WORKERS = int(os.getenv('TRANSCRIBE_WORKERS', '2'))
+JOB_LEASE_SEC = int(os.getenv('JOB_LEASE_SEC', '120'))
+JOB_HEARTBEAT_SEC = int(os.getenv('JOB_HEARTBEAT_SEC', '30'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+QUEUE_POLL_SEC = int(os.getenv('QUEUE_POLL_SEC', '10'))
+# Backpressure: при стольких задачах в очереди POST / отвечает 429 (0 — без лимита)
+QUEUE_MAX_DEPTH = int(os.getenv('QUEUE_MAX_DEPTH', '1000'))
+QUEUE_RETRY_AFTER_SEC = int(os.getenv('QUEUE_RETRY_AFTER_SEC', '60'))
+# Планировщик: записи за последние QUEUE_FRESH_DAYS дней (дата из имени) встают впереди задач,
+# поставленных до QUEUE_FRESH_BOOST_SEC раньше (бэкфилл архива); задача, прождавшая дольше
+# буста, обгоняет и свежие — голодания нет
+QUEUE_FRESH_DAYS = int(os.getenv('QUEUE_FRESH_DAYS', '1'))
+QUEUE_FRESH_BOOST_SEC = float(os.getenv('QUEUE_FRESH_BOOST_SEC', '86400'))
+# Запуски дайджестов (WF03 22:00, WF02 23:00; время контейнера, TZ): оценка, успеет ли очередь.
+# QUEUE_DEADLINE_MODE=1 — свежие не успевают к ближайшему: aging отключается, свежие строго первыми
+DIGEST_CUTOFFS = sorted(
+    tuple(int(part) for part in t.strip().split(':'))
+    for t in os.getenv('DIGEST_CUTOFFS', '22:00,23:00').split(',') if t.strip()
+)
+QUEUE_DEADLINE_MODE = os.getenv('QUEUE_DEADLINE_MODE', '1') == '1'
+DEADLINE_CHECK_SEC = float(os.getenv('DEADLINE_CHECK_SEC', '30'))
+
+# Кэш транскриптов по хешу содержимого (transcript_cache): повторный файл
+# под другим именем не отправляется провайдеру. AUDIO_FINGERPRINT=1 — ещё и хеш
+# декодированного PCM (совпадает после перепаковки контейнера без перекодирования)
+TRANSCRIPT_CACHE = os.getenv('TRANSCRIPT_CACHE', '1') == '1'
+AUDIO_FINGERPRINT = os.getenv('AUDIO_FINGERPRINT', '0') == '1'
+
+# Диаризация: AssemblyAI — speaker_labels, остальные провайдеры — локальная
+# кластеризация сегментов по спектру (CPU, нужен numpy). THRESHOLD_DB — RMS-разница
+# спектров (дБ), ниже которой сегменты считаются одним говорящим
+DIARIZATION = os.getenv('DIARIZATION', '0') == '1'
+DIARIZATION_MAX_SPEAKERS = int(os.getenv('DIARIZATION_MAX_SPEAKERS', '6'))
+DIARIZATION_THRESHOLD_DB = float(os.getenv('DIARIZATION_THRESHOLD_DB', '4'))
+
+# /check long-poll: максимум ожидания за один запрос; callback о завершении задачи
+CHECK_MAX_WAIT_SEC = int(os.getenv('CHECK_MAX_WAIT_SEC', '110'))
+CALLBACK_RETRIES = int(os.getenv('CALLBACK_RETRIES', '3'))
+
+# Потоки для блокирующих вызовов из event loop: запросы к БД, хеширование файлов
+BLOCKING_THREADS = int(os.getenv('BLOCKING_THREADS', '8'))
+
+# Лог: stdout + файл с ротацией (LOG_FILE пусто — только stdout). Запись — в отдельном потоке
+LOG_FILE = os.getenv('LOG_FILE', '/tmp/ts.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '3'))
+
+# Уникален для каждого запуска: после рестарта контейнера hostname/pid совпадают
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+
+
+def build_db_dsn():
+    dsn = os.getenv('DB_DSN', '')
+    if dsn:
+        return dsn
+    host = os.getenv('POSTGRES_HOST', 'postgres')
+    port = os.getenv('POSTGRES_PORT', '5432')
+    dbname = os.getenv('POSTGRES_DB', 'n8n')
+    user = os.getenv('POSTGRES_USER', 'n8n')
+    password = os.getenv('POSTGRES_PASSWORD', '')
+    return f"host={host} port={port} dbname={dbname} user={user} password={password}"
+
+
+DB_DSN = build_db_dsn()
+
+# Пул соединений к PostgreSQL (общий на воркеры, /check и housekeeping)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT_SEC = float(os.getenv('DB_POOL_TIMEOUT_SEC', '10'))
+# Соединение, простоявшее дольше, проверяется SELECT 1 перед выдачей
+DB_IDLE_CHECK_SEC = float(os.getenv('DB_IDLE_CHECK_SEC', '30'))
+
+
+# ── Утилиты ─────────────────────────────────────────────────────────────────────────────────
+
+def build_log_listener():
+    """
+    log() только кладёт запись в очередь (QueueHandler) — без I/O в вызывающем потоке.
+    Поток QueueListener пишет в stdout и в LOG_FILE (файл открыт постоянно, ротация по размеру).
+    """
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        try:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8', delay=True))
+        except OSError as e:
+            print(f'LOG_FILE {LOG_FILE}: {e}', file=sys.stderr)
+    formatter = logging.Formatter(f'[%(asctime)s] [{STT_PROVIDER.upper()}] %(message)s', '%Y-%m-%d %H:%M:%S')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger('transcribe')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return logger, logging.handlers.QueueListener(log_queue, *handlers)
+
+
+LOGGER, LOG_LISTENER = build_log_listener()
+
+
+def log(msg):
+    LOGGER.info(msg)
+
+
+def resolve_filepath(filepath):
+    if not filepath:
+        return filepath
+    if os.path.exists(filepath):
+        return filepath
+    if filepath.startswith('/recordings/'):
+        alt = filepath.replace('/recordings/', '/mnt/recordings/', 1)
+        if os.path.exists(alt):
+            return alt
+    return filepath
+
+
+class TokenBucket:
+    """Rate limiter для event loop: не более rate запросов/сек, всплеск до burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Metrics:
+    """
+    Счётчики и гистограммы в памяти → текстовый формат Prometheus (GET /metrics).
+    Метрика описывается в METRIC_HELP; метки — именованные аргументы inc/observe.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self):
+        self.counters = collections.Counter()  # (name, labels) → значение
+        self.histograms = {}                    # (name, labels) → [счётчики корзин..., сумма, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def _labels(cls, labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{cls._escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self, gauges=()):
+        """gauges — [(name, labels dict, value)], снимаются в момент запроса."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(h)) for key, h in self.histograms.items())
+        series = collections.defaultdict(list)
+        for (name, labels), value in counters:
+            series[name].append(f'{name}{self._labels(labels)} {value:g}')
+        for (name, labels), h in histograms:
+            for bound, count in zip(self.BUCKETS, h):
+                series[name].append(f'{name}_bucket{self._labels(labels, [("le", f"{bound:g}")])} {count}')
+            series[name].append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {h[-1]}')
+            series[name].append(f'{name}_sum{self._labels(labels)} {h[-2]:.6f}')
+            series[name].append(f'{name}_count{self._labels(labels)} {h[-1]}')
+        for name, labels, value in gauges:
+            if value is not None:
+                series[name].append(f'{name}{self._labels(sorted(labels.items()))} {value:g}')
+        lines = []
+        for name, rows in series.items():
+            kind, help_text = METRIC_HELP.get(name, ('untyped', ''))
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', *rows]
+        return '\n'.join(lines) + '\n'
+
+
+METRIC_HELP = {
+    'transcribe_jobs_total': ('counter', 'Finished transcription jobs by provider and outcome'),
+    'transcribe_stage_seconds': ('histogram', 'Duration of processing stages'),
+    'transcribe_provider_request_seconds': ('histogram', 'Round-trip time of a single STT provider request'),
+    'transcribe_provider_requests_total': ('counter', 'STT provider requests by outcome'),
+    'transcribe_billed_seconds_total': ('counter', 'Audio seconds billed by the provider'),
+    'transcribe_http_requests_total': ('counter', 'HTTP API requests by path and status code'),
+    'transcribe_cache_lookups_total': ('counter', 'Transcript cache lookups by result'),
+    'transcribe_ingested_files_total': ('counter', 'Files submitted to POST /ingest: new (queued), known or invalid (skipped)'),
+    'transcribe_queue_depth': ('gauge', 'Jobs waiting in the queue'),
+    'transcribe_jobs_active': ('gauge', 'Jobs in progress in this process'),
+    'transcribe_workers': ('gauge', 'Maximum jobs in progress (TRANSCRIBE_WORKERS)'),
+    'transcribe_provider_inflight': ('gauge', 'Jobs in progress per provider'),
+    'transcribe_breaker_state': ('gauge', 'Circuit breaker state: 0 closed, 1 half-open, 2 open'),
+    'transcribe_db_pool_in_use': ('gauge', 'PostgreSQL pool connections in use'),
+    'transcribe_deadline_seconds_left': ('gauge', 'Seconds until the next digest cutoff (DIGEST_CUTOFFS)'),
+    'transcribe_queue_drain_seconds': ('gauge', 'Estimated time to drain queued and running jobs'),
+    'transcribe_db_pool_timeouts_total': ('counter', 'PostgreSQL pool acquire timeouts'),
+}
+
+METRICS = Metrics()
+
+
+class StageTimer:
+    """
+    Время этапов обработки (queue_wait, hash, vad, segment, transcode, upload, recognize, diarize,
+    db_write, job) в памяти: число замеров, суммарное время и p50/p95 по последним WINDOW — в /health;
+    гистограмма transcribe_stage_seconds — в /metrics.
+    """
+
+    WINDOW = 500
+
+    def __init__(self):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.WINDOW))
+        self.counts = collections.Counter()
+        self.totals = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, stage, elapsed):
+        with self._lock:
+            self.samples[stage].append(elapsed)
+            self.counts[stage] += 1
+            self.totals[stage] += elapsed
+        METRICS.observe('transcribe_stage_seconds', elapsed, stage=stage)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start)
+
+    def mean(self, stage):
+        """Среднее по последним WINDOW замерам; None — замеров ещё не было."""
+        with self._lock:
+            values = self.samples.get(stage)
+            return sum(values) / len(values) if values else None
+
+    def as_dict(self):
+        with self._lock:
+            stages = {stage: (self.counts[stage], self.totals[stage], sorted(values))
+                      for stage, values in self.samples.items()}
+        return {stage: {'count': count, 'total_sec': round(total, 2),
+                        'p50_sec': round(values[len(values) // 2], 3),
+                        'p95_sec': round(values[min(len(values) - 1, int(len(values) * 0.95))], 3)}
+                for stage, (count, total, values) in stages.items()}
+
+
+STAGES = StageTimer()
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status, body, retry_after=None):
+        super().__init__(f'HTTP {status}: {body[:200]!r}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+# Общий keep-alive пул соединений на все задачи и провайдеров
+HTTP_CLIENT = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=200, max_keepalive_connections=50))
+
+
+async def http_request(method, url, headers, content=None, timeout=30):
+    """Запрос через HTTP_CLIENT. Возвращает тело ответа, для не-2xx — HTTPStatusError."""
+    resp = await HTTP_CLIENT.request(method, url, headers=headers, content=content, timeout=timeout)
+    if resp.status_code >= 300:
+        raise HTTPStatusError(resp.status_code, resp.content, resp.headers.get('Retry-After'))
+    return resp.content
+
+
+async def http_post(url, content, headers, timeout=30):
+    return await http_request('POST', url, headers, content, timeout)
+
+
+async def http_get_json(url, headers, timeout=15):
+    return json.loads(await http_request('GET', url, headers, timeout=timeout))
+
+
+UPLOAD_BLOCK = 256 * 1024
+
+
+async def iter_file_blocks(filepath, block_size=UPLOAD_BLOCK):
+    """Чтение файла блоками (read — в потоке) — потоковая загрузка без копии файла в памяти."""
+    with open(filepath, 'rb') as f:
+        while block := await asyncio.to_thread(f.read, block_size):
+            yield block
+
+
+def multipart_file_body(boundary, field, filepath, filename, mime, fields=()):
+    """
+    multipart/form-data потоком: (Content-Length, async-генератор блоков).
+    Файл читается с диска по UPLOAD_BLOCK — память не зависит от размера файла.
+    """
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: {mime}\r\n\r\n'
+    ).encode()
+    tail = b''.join(
+        f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}'.encode()
+        for name, value in fields
+    ) + f'\r\n--{boundary}--\r\n'.encode()
+
+    async def body():
+        yield head
+        async for block in iter_file_blocks(filepath):
+            yield block
+        yield tail
+
+    return len(head) + os.path.getsize(filepath) + len(tail), body()
+
+
+def is_transient(e):
+    """Сетевая ошибка, 429 или 5xx — повтор может пройти; прочие 4xx — проблема запроса."""
+    if isinstance(e, HTTPStatusError):
+        return e.status == 429 or e.status >= 500
+    return isinstance(e, (httpx.TransportError, OSError))
+
+
+async def with_retries(fn, retries, base_delay=0.5, max_delay=20):
+    """
+    Повтор await fn() с экспоненциальной задержкой и jitter.
+    Повторяем сетевые ошибки, 429 и 5xx; прочие 4xx — сразу наверх.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await fn()
+        except (HTTPStatusError, httpx.TransportError, OSError) as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            retry_after = getattr(e, 'retry_after', None) or ''
+            delay = float(retry_after) if retry_after.isdigit() else None
+        if delay is None:
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+        await asyncio.sleep(delay)
+
+
+class ProviderUnavailable(Exception):
+    """Провайдер недоступен (circuit breaker открыт, модель ещё грузится) — задачу откладываем на retry_after сек."""
+
+    def __init__(self, provider, retry_after, reason='circuit open'):
+        super().__init__(f'{provider} unavailable ({reason}), retry in {retry_after}s')
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Предохранитель провайдера: closed → open, когда доля ошибок за BREAKER_WINDOW_SEC
+    не меньше BREAKER_ERROR_RATE (при BREAKER_MIN_CALLS+ вызовах). Через BREAKER_OPEN_SEC —
+    half_open: до BREAKER_HALF_OPEN_CALLS пробных вызовов; все успешны — closed, ошибка — снова open.
+    Ошибки — 429, 5xx и сетевые; прочие 4xx — проблема запроса, не провайдера.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.calls = collections.deque()  # (время, успех) за окно
+        self.probes = 0
+        self.probe_ok = 0
+        self.trips = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def _tick(self, now):
+        if self.state == 'open' and now >= self.opened_at + BREAKER_OPEN_SEC:
+            self.state, self.probes, self.probe_ok = 'half_open', 0, 0
+            log(f'BREAKER HALF-OPEN: {self.name}')
+
+    def _open(self, now):
+        self.state, self.opened_at = 'open', now
+        self.trips += 1
+        self.calls.clear()
+        log(f'BREAKER OPEN: {self.name} for {BREAKER_OPEN_SEC:.0f}s')
+
+    def retry_after(self):
+        """Через сколько секунд провайдер снова примет вызов (0 — уже принимает)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tick(now)
+            if self.state == 'open':
+                return max(1, math.ceil(self.opened_at + BREAKER_OPEN_SEC - now))
+            return 0
+
+    def _before(self):
+        """Разрешение на вызов: 'call', 'probe' (пробный half-open) или 'wait' (пробы заняты)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tick(now)
+            if self.state == 'open':
+                self.rejected += 1
+                raise ProviderUnavailable(self.name, max(1, math.ceil(self.opened_at + BREAKER_OPEN_SEC - now)))
+            if self.state == 'half_open':
+                if self.probes >= BREAKER_HALF_OPEN_CALLS:
+                    return 'wait'
+                self.probes += 1
+                return 'probe'
+            return 'call'
+
+    def _record(self, ok, probe):
+        with self._lock:
+            now = time.monotonic()
+            if probe:
+                self.probes -= 1
+                if self.state != 'half_open' or ok is None:
+                    return
+                if not ok:
+                    self._open(now)
+                    return
+                self.probe_ok += 1
+                if self.probe_ok >= BREAKER_HALF_OPEN_CALLS:
+                    self.state = 'closed'
+                    log(f'BREAKER CLOSED: {self.name}')
+                return
+            if ok is None:
+                return
+            self.calls.append((now, ok))
+            while self.calls and self.calls[0][0] < now - BREAKER_WINDOW_SEC:
+                self.calls.popleft()
+            failed = sum(1 for _, c in self.calls if not c)
+            if (self.state == 'closed' and len(self.calls) >= BREAKER_MIN_CALLS
+                    and failed / len(self.calls) >= BREAKER_ERROR_RATE):
+                self._open(now)
+
+    async def call(self, fn):
+        """
+        await fn() под предохранителем; открыт — сразу ProviderUnavailable.
+        В half-open сверх пробных вызовов ждём, чем закончатся пробы.
+        """
+        while (mode := self._before()) == 'wait':
+            await asyncio.sleep(0.2)
+        probe = mode == 'probe'
+        ok = None
+        outcome = 'error'
+        start = time.monotonic()
+        try:
+            result = await fn()
+            ok, outcome = True, 'ok'
+            return result
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        except HTTPStatusError as e:
+            ok = not (e.status == 429 or e.status >= 500)
+            outcome = str(e.status)
+            raise
+        except (httpx.TransportError, OSError):
+            ok, outcome = False, 'transport_error'
+            raise
+        finally:
+            self._record(ok, probe)
+            METRICS.observe('transcribe_provider_request_seconds', time.monotonic() - start, provider=self.name)
+            METRICS.inc('transcribe_provider_requests_total', provider=self.name, outcome=outcome)
+
+    def as_dict(self):
+        retry_after = self.retry_after()
+        with self._lock:
+            failed = sum(1 for _, c in self.calls if not c)
+            return {'state': self.state, 'trips': self.trips, 'rejected': self.rejected,
+                    'window_calls': len(self.calls),
+                    'window_error_rate': round(failed / len(self.calls), 3) if self.calls else None,
+                    'retry_after': retry_after}
+
+
+BREAKERS = {name: CircuitBreaker(name) for name in ('speechkit', 'whisper', 'local_whisper', 'assemblyai')}
+
+
+def parse_recording_name(filename, mtime=None):
+    """
+    LEAD_ID и дата из имени файла — те же правила, что были в WF01 (Parse Filenames & LEAD_ID).
+    Даты в имени нет — дата mtime файла (если известна), иначе сегодня.
+    """
+    m = re.match(r'^(\d+)[_\-.]', filename)
+    lead_id = m.group(1) if m else 'UNKNOWN'
+    m = re.search(r'(\d{4}-\d{2}-\d{2})', filename)
+    file_date = m.group(1) if m else time.strftime('%Y-%m-%d', time.localtime(mtime))
+    return lead_id, file_date
+
+
+# ── Event loop задач ───────────────────────────────────────────────────────────────────────────
+
+BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix='blocking')
+
+
+class AsyncRunner:
+    """
+    Один event loop в отдельном потоке. На нём идут задачи транскрибации:
+    HTTP к провайдерам, polling и процессы ffmpeg не держат поток на задачу,
+    блокирующие вызовы (psycopg2, хеширование) — через blocking().
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+
+    def start(self):
+        threading.Thread(target=self.loop.run_forever, name='event-loop', daemon=True).start()
+
+    def submit(self, coro):
+        """Из любого потока: запускает корутину на loop, возвращает concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+
+RUNNER = AsyncRunner()
+
+
+async def blocking(fn, *args, **kwargs):
+    """Блокирующий вызов в BLOCKING_EXECUTOR, не останавливая event loop."""
+    return await asyncio.get_running_loop().run_in_executor(
+        BLOCKING_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+
+# ── База данных ───────────────────────────────────────────────────────────────────────────────
+
+class DBPool:
+    """
+    ThreadedConnectionPool + семафор: при исчерпании пула запрос ждёт
+    до DB_POOL_TIMEOUT_SEC, а не падает с PoolError. Закрытые соединения
+    и соединения после простоя дольше DB_IDLE_CHECK_SEC проверяются
+    перед выдачей и при необходимости заменяются новыми.
+    """
+
+    def __init__(self, dsn, minconn, maxconn):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._idle_since = {}
+        self.in_use = 0  # выданные getconn и не возвращённые putconn
+        self.acquired = 0
+        self.timeouts = 0
+        self.replaced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.queries = 0
+        self.query_total = 0.0
+        self.query_max = 0.0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+            return self._pool
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT_SEC):
+            with self._lock:
+                self.timeouts += 1
+            raise psycopg2.pool.PoolError(f'DB pool exhausted ({self.maxconn} in use, waited {DB_POOL_TIMEOUT_SEC}s)')
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            idle = start - self._idle_since.pop(id(conn), start)
+            if conn.closed or idle > DB_IDLE_CHECK_SEC:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute('SELECT 1')
+                    conn.rollback()
+                except psycopg2.Error:
+                    pool.putconn(conn, close=True)
+                    conn = pool.getconn()
+                    with self._lock:
+                        self.replaced += 1
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time.monotonic() - start
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    def putconn(self, conn, elapsed, broken=False):
+        close = broken or bool(conn.closed)
+        try:
+            self._pool.putconn(conn, close=close)
+            if not close:
+                self._idle_since[id(conn)] = time.monotonic()
+        finally:
+            self._slots.release()
+        with self._lock:
+            self.in_use -= 1
+            self.queries += 1
+            self.query_total += elapsed
+            self.query_max = max(self.query_max, elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size_max': self.maxconn,
+                'in_use': self.in_use,
+                'acquired': self.acquired,
+                'timeouts': self.timeouts,
+                'replaced_stale': self.replaced,
+                'wait_avg_ms': round(self.wait_total / self.acquired * 1000, 2) if self.acquired else 0,
+                'wait_max_ms': round(self.wait_max * 1000, 2),
+                'query_avg_ms': round(self.query_total / self.queries * 1000, 2) if self.queries else 0,
+                'query_max_ms': round(self.query_max * 1000, 2),
+            }
+
+
+DB_POOL = DBPool(DB_DSN, DB_POOL_MIN, DB_POOL_MAX)
+
+
+@contextmanager
+def db_cursor():
+    """Курсор в транзакции из пула: commit при выходе, rollback при исключении."""
+    conn = DB_POOL.getconn()
+    start = time.monotonic()
+    broken = False
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                yield cur
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        DB_POOL.putconn(conn, time.monotonic() - start, broken)
+
+
+def db_update(filename, status, transcript=None, error=None, segments=None):
+    """Финальный статус задачи; снимает аренду. Возвращает callback_url задачи."""
+    try:
+        with db_cursor() as cur:
+            cur.execute(
+                """UPDATE processed_files
+                   SET status=%s,
+                       transcript_text=COALESCE(%s, transcript_text),
+                       transcript_segments=COALESCE(%s::jsonb, transcript_segments),
+                       error_message=%s,
+                       completed_at=CASE WHEN %s='completed' THEN NOW() ELSE completed_at END,
+                       progress=CASE WHEN %s='completed' THEN 100 ELSE progress END,
+                       lease_owner=NULL, lease_expires_at=NULL
+                   WHERE filename=%s
+                   RETURNING callback_url""",
+                (status, transcript, pack_segments(segments), error, status, status, filename)
+            )
+            row = cur.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        log(f'DB ERR: {e}')
+
+
+def db_set(filename, **fields):
+    """Обновляет служебные колонки processed_files (имена колонок — только из кода)."""
+    if not fields:
+        return
+    cols = ', '.join(f'{k}=%s' for k in fields)
+    try:
+        with db_cursor() as cur:
+            cur.execute(f'UPDATE processed_files SET {cols} WHERE filename=%s',
+                        (*fields.values(), filename))
+    except Exception as e:
+        log(f'DB ERR: {e}')
+
+
+# ── Сегменты транскрипта ─────────────────────────────────────────────────────────────────────
+# Провайдер возвращает (text, segments); сегмент — {'start', 'end', 'speaker', 'text'}, время в сек.
+# В БД (processed_files.transcript_segments, transcript_cache.segments) — колоночный JSONB:
+# {"start": [...], "end": [...], "speaker": [...], "text": [...]}
+
+SEGMENT_FIELDS = ('start', 'end', 'speaker', 'text')
+SEGMENT_MAX_SEC = 30
+SEGMENT_MAX_GAP_SEC = 1.5
+
+
+def pack_segments(segments):
+    """Сегменты → JSON по колонкам (имена полей не повторяются в каждой строке)."""
+    if not segments:
+        return None
+    return json.dumps({
+        'start': [round(seg['start'], 2) for seg in segments],
+        'end': [round(seg['end'], 2) for seg in segments],
+        'speaker': [seg.get('speaker') for seg in segments],
+        'text': [seg['text'] for seg in segments],
+    }, ensure_ascii=False)
+
+
+def unpack_segments(columns):
+    if not columns:
+        return []
+    return [dict(zip(SEGMENT_FIELDS, row)) for row in zip(*(columns[k] for k in SEGMENT_FIELDS))]
+
+
+def segments_from_words(words):
+    """
+    Слова с таймингами (мс, как у AssemblyAI) → сегменты. Граница — конец предложения,
+    пауза длиннее SEGMENT_MAX_GAP_SEC, смена говорящего или сегмент длиннее SEGMENT_MAX_SEC.
+    """
+    segments, current = [], None
+    for w in words:
+        start, end, speaker = w['start'] / 1000, w['end'] / 1000, w.get('speaker')
+        if current and (start - current['end'] > SEGMENT_MAX_GAP_SEC or speaker != current['speaker']
+                        or end - current['start'] > SEGMENT_MAX_SEC):
+            segments.append(current)
+            current = None
+        if current is None:
+            current = {'start': start, 'end': end, 'speaker': speaker, 'text': w['text']}
+        else:
+            current['end'] = end
+            current['text'] += ' ' + w['text']
+        if w['text'][-1:] in '.?!':
+            segments.append(current)
+            current = None
+    if current:
+        segments.append(current)
+    return segments
+
+
+def load_segments(filename):
+    """(status, колоночные сегменты) задачи или None."""
+    with db_cursor() as cur:
+        cur.execute('SELECT status, transcript_segments FROM processed_files WHERE filename=%s', (filename,))
+        return cur.fetchone()
+
+
+# ── Кэш транскриптов (transcript_cache) ────────────────────────────────────────────────────────
+
+HASH_BLOCK = 1024 * 1024
+
+
+def file_sha256(filepath):
+    """Потоковый SHA-256 файла блоками по 1 MB."""
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+async def pcm_fingerprint(filepath):
+    """SHA-256 декодированного звука (8 kHz моно s16le) — не зависит от контейнера."""
+    h = hashlib.sha256()
+    async with FFMPEG_SLOTS:
+        proc = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-loglevel', 'error', '-i', filepath, '-vn',
+            '-ac', '1', '-ar', '8000', '-f', 's16le', 'pipe:1',
+            stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL
+        )
+        try:
+            async with asyncio.timeout(FFMPEG_TIMEOUT_SEC):
+                while block := await proc.stdout.read(HASH_BLOCK):
+                    h.update(block)
+                rc = await proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+    if rc != 0:
+        raise RuntimeError(f'ffmpeg fingerprint error (rc={rc})')
+    return h.hexdigest()
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self):
+        total = self.hits + self.misses
+        return {'enabled': TRANSCRIPT_CACHE, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else None}
+
+
+CACHE_STATS = CacheStats()
+
+
+def cache_lookup(content_hash, pcm_hash=None):
+    """(транскрипт, колоночные сегменты) по хешу файла (или PCM-отпечатку). None — промах."""
+    with db_cursor() as cur:
+        cur.execute(
+            """UPDATE transcript_cache SET hits=hits + 1, last_hit_at=NOW()
+               WHERE content_hash = (
+                   SELECT content_hash FROM transcript_cache
+                   WHERE content_hash=%s OR (%s IS NOT NULL AND pcm_hash=%s)
+                   ORDER BY (content_hash=%s) DESC
+                   LIMIT 1
+               )
+               RETURNING transcript_text, segments""",
+            (content_hash, pcm_hash, pcm_hash, content_hash)
+        )
+        return cur.fetchone()
+
+
+def cache_store(content_hash, pcm_hash, transcript, segments, provider):
+    with db_cursor() as cur:
+        cur.execute(
+            """INSERT INTO transcript_cache (content_hash, pcm_hash, transcript_text, segments, provider)
+               VALUES (%s, %s, %s, %s::jsonb, %s)
+               ON CONFLICT (content_hash) DO UPDATE
+                   SET pcm_hash=COALESCE(EXCLUDED.pcm_hash, transcript_cache.pcm_hash),
+                       transcript_text=EXCLUDED.transcript_text,
+                       segments=EXCLUDED.segments,
+                       provider=EXCLUDED.provider""",
+            (content_hash, pcm_hash, transcript, pack_segments(segments), provider)
+        )
+
+
+# ── Чекпоинты чанков (transcript_chunks) ───────────────────────────────────────────────────────
+
+def chunk_plan_id(plan, chunk_sec):
+    """Идентификатор нарезки: чанки одного файла совпадают только при той же нарезке (VAD, параметры)."""
+    if plan is None:
+        return f'fixed:{chunk_sec:g}'
+    spans = ';'.join(','.join(f'{a:.3f}-{b:.3f}' for a, b in chunk) for chunk in plan)
+    return 'vad:' + hashlib.sha1(spans.encode()).hexdigest()[:16]
+
+
+def load_chunks(content_hash, plan_id):
+    """Уже распознанные чанки: {chunk_index: text}."""
+    with db_cursor() as cur:
+        cur.execute(
+            """SELECT chunk_index, text FROM transcript_chunks
+               WHERE content_hash=%s AND plan_id=%s""",
+            (content_hash, plan_id)
+        )
+        return dict(cur.fetchall())
+
+
+def save_chunk(filename, content_hash, plan_id, index, start, end, text, provider, progress):
+    """Результат чанка + прогресс задачи — в одной транзакции."""
+    with db_cursor() as cur:
+        cur.execute(
+            """INSERT INTO transcript_chunks
+                   (content_hash, plan_id, chunk_index, start_sec, end_sec, text, provider)
+               VALUES (%s, %s, %s, %s, %s, %s, %s)
+               ON CONFLICT (content_hash, plan_id, chunk_index) DO UPDATE SET text=EXCLUDED.text""",
+            (content_hash, plan_id, index, start, end, text, provider)
+        )
+        if progress is not None:
+            cur.execute('UPDATE processed_files SET progress=%s WHERE filename=%s', (progress, filename))
+
+
+def clear_chunks(content_hash):
+    """Транскрипт собран и сохранён — чекпоинты больше не нужны."""
+    with db_cursor() as cur:
+        cur.execute('DELETE FROM transcript_chunks WHERE content_hash=%s', (content_hash,))
+
+
+# ── Очередь задач (processed_files) ─────────────────────────────────────────────────────────────
+
+def enqueue_job(filename, filepath, priority=0, callback_url=None, requeue=False):
+    """
+    Ставит файл в очередь (создаёт строку, если её ещё нет — POST /).
+    Уже стоящую в очереди или арендованную задачу не трогаем (только callback_url).
+    transcribing без аренды (строка от WF01 до v3) — ставим в очередь.
+    Завершённую (completed, error) — только с requeue=True: иначе повторный POST /
+    после /ingest стёр бы готовый транскрипт и распознал файл второй раз.
+    Повторная постановка начинает задачу заново: попытки, прогресс и сегменты сбрасываются.
+    Возвращает (queued, status): queued=False — задача уже в работе или завершена.
+    """
+    lead_id, file_date = parse_recording_name(filename)
+    try:
+        size = os.path.getsize(filepath)
+    except OSError:
+        size = None
+    with db_cursor() as cur:
+        cur.execute(
+            """INSERT INTO processed_files
+                   (filename, filepath, lead_id, file_date, file_size_bytes, status, priority, queued_at,
+                    sched_at, callback_url)
+               VALUES (%s, %s, %s, %s, %s, 'queued', %s, NOW(), NOW() - make_interval(secs => %s), %s)
+               ON CONFLICT (filename) DO UPDATE
+                   SET filepath=EXCLUDED.filepath,
+                       callback_url=EXCLUDED.callback_url,
+                       file_size_bytes=EXCLUDED.file_size_bytes,
+                       status='queued',
+                       priority=EXCLUDED.priority,
+                       queued_at=NOW(),
+                       sched_at=EXCLUDED.sched_at,
+                       retry_at=NULL,
+                       retry_count=0,
+                       progress=NULL,
+                       transcript_text=NULL,
+                       transcript_segments=NULL,
+                       error_message=NULL,
+                       operation_id=NULL,
+                       lease_owner=NULL, lease_expires_at=NULL
+                   WHERE NOT (processed_files.status IN ('queued', 'awaiting_provider')
+                              OR (processed_files.status = 'transcribing'
+                                  AND COALESCE(processed_files.lease_expires_at > NOW(), FALSE)))
+                     AND (%s OR processed_files.status NOT IN ('completed', 'error'))
+               RETURNING status""",
+            (filename, filepath, lead_id, file_date, size, priority, queue_boost(file_date), callback_url,
+             requeue)
+        )
+        if cur.fetchone():
+            return True, 'queued'
+        if callback_url:
+            cur.execute('UPDATE processed_files SET callback_url=%s WHERE filename=%s', (callback_url, filename))
+        cur.execute('SELECT status FROM processed_files WHERE filename=%s', (filename,))
+        row = cur.fetchone()
+        return False, row[0] if row else 'not_found'
+
+
+def parse_priority(value):
+    """priority из тела запроса: целое в диапазоне INTEGER (строка с целым — тоже), нет — 0; иначе ValueError."""
+    if value is None or value == '':
+        return 0
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(value)
+    try:
+        priority = int(value)
+    except (TypeError, OverflowError):
+        raise ValueError(value) from None
+    if not -2 ** 31 <= priority < 2 ** 31:
+        raise ValueError(value)
+    return priority
+
+
+def ingest_entry(entry):
+    """
+    Проверка записи /ingest → {filepath, filename, size, mtime} с приведёнными типами.
+    Ошибка — ValueError с причиной: одна битая запись не должна ронять всю пачку.
+    """
+    if not isinstance(entry, dict):
+        raise ValueError('entry must be an object')
+    filepath = entry.get('filepath')
+    if not isinstance(filepath, str) or not filepath:
+        raise ValueError('filepath (string) required')
+    filename = entry.get('filename') or filepath.split('/')[-1]
+    if not isinstance(filename, str) or not filename:
+        raise ValueError('filename must be a non-empty string')
+    size, mtime = entry.get('size'), entry.get('mtime')
+    try:
+        size = int(size) if size is not None else None
+        mtime = float(mtime) if mtime is not None else None
+    except (TypeError, ValueError):
+        raise ValueError('size and mtime must be numbers') from None
+    if (size is not None and size < 0) or (mtime is not None and not math.isfinite(mtime)):
+        raise ValueError('size must be >= 0, mtime finite')
+    return {'filepath': filepath, 'filename': filename, 'size': size, 'mtime': mtime}
+
+
+def ingest_files(files, priority=0, dirs=None):
+    """
+    Пачка проверенных файлов (ingest_entry) [{filepath, filename, size, mtime}] → новые строки со status=queued
+    одним INSERT … SELECT FROM unnest: известные файлы (любой статус) не трогаются, проверка
+    и вставка атомарны. Возвращает [(filename, filepath)] только вставленных.
+    В той же транзакции — манифест: файлы (path, size, mtime) и mtime просмотренных каталогов
+    dirs [{path, mtime}] (mtime null — каталог удалён).
+    """
+    rows = {}
+    for f in files:
+        filename = f['filename']
+        if filename in rows:
+            continue
+        lead_id, file_date = parse_recording_name(filename, f['mtime'])
+        rows[filename] = (f['filepath'], lead_id, file_date, f['size'], f['mtime'], queue_boost(file_date))
+    with db_cursor() as cur:
+        if dirs:
+            manifest_dirs(cur, dirs)
+        if not rows:
+            return []
+        filepaths, lead_ids, file_dates, sizes, mtimes, boosts = zip(*rows.values())
+        manifest = {path: (size, mtime) for path, size, mtime in zip(filepaths, sizes, mtimes)}
+        # Файл изменился (размер/mtime) — хеш содержимого в манифесте больше не действителен
+        cur.execute(
+            """INSERT INTO recordings_manifest (path, size_bytes, mtime)
+               SELECT * FROM unnest(%s::varchar[], %s::bigint[], %s::float8[])
+               ON CONFLICT (path) DO UPDATE
+                   SET size_bytes=EXCLUDED.size_bytes, mtime=EXCLUDED.mtime, seen_at=NOW(),
+                       content_hash=CASE
+                           WHEN (recordings_manifest.size_bytes, recordings_manifest.mtime)
+                                IS NOT DISTINCT FROM (EXCLUDED.size_bytes, EXCLUDED.mtime)
+                           THEN recordings_manifest.content_hash END""",
+            (list(manifest), [v[0] for v in manifest.values()], [v[1] for v in manifest.values()])
+        )
+        cur.execute(
+            """INSERT INTO processed_files
+                   (filename, filepath, lead_id, file_date, file_size_bytes, status, priority, queued_at, sched_at)
+               SELECT f.filename, f.filepath, f.lead_id, f.file_date, f.size, 'queued', %s, NOW(),
+                      NOW() - make_interval(secs => f.boost)
+               FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[], %s::date[], %s::bigint[], %s::float8[])
+                    AS f(filename, filepath, lead_id, file_date, size, boost)
+               ON CONFLICT (filename) DO NOTHING
+               RETURNING filename, filepath""",
+            (priority, list(rows), list(filepaths), list(lead_ids), list(file_dates), list(sizes), list(boosts))
+        )
+        return cur.fetchall()
+
+
+def manifest_dirs(cur, dirs):
+    """mtime каталогов, просмотренных сверкой: неизменившийся каталог следующая сверка не перечисляет."""
+    gone = [d['path'] for d in dirs if d.get('mtime') is None]
+    seen = [d for d in dirs if d.get('mtime') is not None]
+    if gone:
+        cur.execute('DELETE FROM recordings_dirs WHERE path = ANY(%s) OR path LIKE ANY(%s)',
+                    (gone, [p.replace('%', r'\%').replace('_', r'\_') + '/%' for p in gone]))
+    if seen:
+        cur.execute(
+            """INSERT INTO recordings_dirs (path, mtime)
+               SELECT * FROM unnest(%s::varchar[], %s::float8[])
+               ON CONFLICT (path) DO UPDATE SET mtime=EXCLUDED.mtime, scanned_at=NOW()""",
+            ([d['path'] for d in seen], [float(d['mtime']) for d in seen])
+        )
+
+
+def load_manifest_dirs():
+    with db_cursor() as cur:
+        cur.execute('SELECT path, mtime FROM recordings_dirs')
+        return dict(cur.fetchall())
+
+
+def manifest_set_hash(filepath, content_hash):
+    try:
+        with db_cursor() as cur:
+            cur.execute('UPDATE recordings_manifest SET content_hash=%s WHERE path=%s', (content_hash, filepath))
+    except Exception as e:
+        log(f'DB ERR: {e}')
+
+
+def claim_job():
+    """
+    Забирает следующую задачу: (filename, filepath, сек в очереди). None — очередь пуста.
+    Порядок — priority DESC, sched_at (свежие впереди бэкфилла, с aging); свежие не успевают
+    к ближайшему дайджесту (QUEUE_DEADLINE_MODE) — свежие строго первыми.
+    """
+    fresh_first = DEADLINE.fresh_first()
+    order = 'priority DESC, COALESCE(file_date >= %s, FALSE) DESC, sched_at, id' if fresh_first else 'priority DESC, sched_at, id'
+    with db_cursor() as cur:
+        cur.execute(
+            f"""UPDATE processed_files
+               SET status='transcribing', lease_owner=%s,
+                   lease_expires_at=NOW() + make_interval(secs => %s),
+                   heartbeat_at=NOW()
+               WHERE id = (
+                   SELECT id FROM processed_files
+                   WHERE status='queued' AND (retry_at IS NULL OR retry_at <= NOW())
+                   ORDER BY {order}
+                   LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING filename, filepath, EXTRACT(EPOCH FROM NOW() - queued_at)""",
+            (WORKER_ID, JOB_LEASE_SEC, *((fresh_from(),) if fresh_first else ()))
+        )
+        return cur.fetchone()
+
+
+def heartbeat_jobs(filenames):
+    """Продлевает аренду задач, которые сейчас обрабатывает этот процесс."""
+    if not filenames:
+        return
+    with db_cursor() as cur:
+        cur.execute(
+            """UPDATE processed_files
+               SET heartbeat_at=NOW(), lease_expires_at=NOW() + make_interval(secs => %s)
+               WHERE lease_owner=%s AND status='transcribing' AND filename = ANY(%s)""",
+            (JOB_LEASE_SEC, WORKER_ID, list(filenames))
+        )
+
+
+def requeue_expired():
+    """
+    Crash recovery: задачи со статусом transcribing и просроченной арендой
+    возвращаются в очередь (с исходным queued_at), после JOB_MAX_ATTEMPTS — error.
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """UPDATE processed_files
+               SET status=CASE WHEN COALESCE(retry_count, 0) + 1 >= %s THEN 'error' ELSE 'queued' END,
+                   error_message=CASE WHEN COALESCE(retry_count, 0) + 1 >= %s
+                                      THEN 'lease expired: ' || COALESCE(lease_owner, '?')
+                                      ELSE error_message END,
+                   retry_count=COALESCE(retry_count, 0) + 1,
+                   queued_at=COALESCE(queued_at, created_at),
+                   sched_at=COALESCE(sched_at, queued_at, created_at),
+                   lease_owner=NULL, lease_expires_at=NULL
+               WHERE status='transcribing' AND lease_expires_at < NOW()
+               RETURNING filename, status""",
+            (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS)
+        )
+        return cur.fetchall()
+
+
+def requeue_job(filename, delay_sec, reason):
+    """
+    Провайдер недоступен (circuit breaker): задача обратно в очередь не раньше
+    чем через delay_sec, место в очереди (queued_at) и счётчик попыток сохраняются.
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """UPDATE processed_files
+               SET status='queued', retry_at=NOW() + make_interval(secs => %s), error_message=%s,
+                   lease_owner=NULL, lease_expires_at=NULL
+               WHERE filename=%s AND status='transcribing' AND lease_owner=%s""",
+            (delay_sec, reason, filename, WORKER_ID)
+        )
+
+
+def queue_depth():
+    with db_cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM processed_files WHERE status='queued'")
+        return cur.fetchone()[0]
+
+
+def fresh_from():
+    """Первая «свежая» дата записи: сегодня − (QUEUE_FRESH_DAYS − 1)."""
+    return time.strftime('%Y-%m-%d', time.localtime(time.time() - 86400 * max(0, QUEUE_FRESH_DAYS - 1)))
+
+
+def queue_boost(file_date):
+    """На сколько секунд раньше queued_at встаёт задача (sched_at): свежая — на QUEUE_FRESH_BOOST_SEC."""
+    return QUEUE_FRESH_BOOST_SEC if str(file_date) >= fresh_from() else 0.0
+
+
+def next_cutoff(now):
+    """Ближайший запуск дайджеста после now: ('HH:MM', epoch) или None."""
+    lt = time.localtime(now)
+    best = None
+    for hour, minute in DIGEST_CUTOFFS:
+        for day in (0, 1):  # сегодня или, если уже прошло, завтра (mktime нормализует день)
+            at = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + day, hour, minute, 0, 0, 0, -1))
+            if at > now:
+                break
+        if best is None or at < best[1]:
+            best = (f'{hour:02d}:{minute:02d}', at)
+    return best
+
+
+class DeadlineEstimator:
+    """
+    Успеет ли очередь к ближайшему дайджесту: задачи в очереди и в работе × среднее время задачи
+    (STAGES job, последние замеры) / TRANSCRIBE_WORKERS — отдельно для свежих (при fresh-first они
+    идут первыми) и для всей очереди. Кэш на DEADLINE_CHECK_SEC: вызывается из claim_job.
+    """
+
+    def __init__(self):
+        self._value = None
+        self._at = 0.0
+        self._lock = threading.Lock()
+
+    def estimate(self):
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._at < DEADLINE_CHECK_SEC:
+                return self._value
+        value = self._estimate()
+        with self._lock:
+            self._value, self._at = value, time.monotonic()
+        return value
+
+    def fresh_first(self):
+        if not QUEUE_DEADLINE_MODE or not DIGEST_CUTOFFS:
+            return False
+        try:
+            return bool(self.estimate()['fresh_at_risk'])
+        except Exception as e:
+            log(f'DEADLINE ERR: {e}')
+            return False
+
+    @staticmethod
+    def _estimate():
+        now = time.time()
+        fresh = fresh_from()
+        with db_cursor() as cur:
+            cur.execute(
+                """SELECT COUNT(*) FILTER (WHERE file_date >= %s), COUNT(*)
+                   FROM processed_files WHERE status IN ('queued', 'transcribing')""",
+                (fresh,)
+            )
+            fresh_jobs, jobs = cur.fetchone()
+        info = {'fresh_from': fresh, 'fresh_jobs': fresh_jobs, 'jobs': jobs}
+        cutoff = next_cutoff(now)
+        if cutoff is None:
+            return {**info, 'next_cutoff': None, 'mode': 'aging'}
+        left = cutoff[1] - now
+        job_sec = STAGES.mean('job')
+        if job_sec is None:
+            # ещё ни одной завершённой задачи — оценивать не по чему
+            return {**info, 'next_cutoff': cutoff[0], 'seconds_left': int(left), 'job_sec': None,
+                    'fresh_drain_sec': None, 'drain_sec': None, 'fresh_at_risk': None, 'on_time': None,
+                    'mode': 'aging'}
+        fresh_drain = math.ceil(fresh_jobs / POOL.size) * job_sec
+        drain = math.ceil(jobs / POOL.size) * job_sec
+        at_risk = fresh_drain > left
+        return {
+            **info,
+            'next_cutoff': cutoff[0],
+            'seconds_left': int(left),
+            'job_sec': round(job_sec, 1),
+            'fresh_drain_sec': int(fresh_drain),
+            'drain_sec': int(drain),
+            'fresh_at_risk': at_risk,
+            'on_time': drain <= left,
+            'mode': 'fresh_first' if QUEUE_DEADLINE_MODE and at_risk else 'aging',
+        }
+
+
+DEADLINE = DeadlineEstimator()
+
+
+def defer_job(filename, operation_id):
+    """
+    Провайдер принял задачу асинхронно: снимаем аренду, воркер свободен,
+    задача ждёт webhook в статусе awaiting_provider. Если webhook успел раньше
+    (задача уже не transcribing у этого воркера) — ничего не меняем.
+    """
+    with db_cursor() as cur:
+        cur.execute(
+            """UPDATE processed_files
+               SET status='awaiting_provider', operation_id=%s,
+                   lease_owner=NULL, lease_expires_at=NULL
+               WHERE filename=%s AND status='transcribing' AND lease_owner=%s""",
+            (operation_id, filename, WORKER_ID)
+        )
+        return cur.rowcount > 0
+
+
+def job_status(filename):
+    """(status, content_hash, operation_id) задачи или None."""
+    with db_cursor() as cur:
+        cur.execute('SELECT status, content_hash, operation_id FROM processed_files WHERE filename=%s',
+                    (filename,))
+        return cur.fetchone()
+
+
+def stale_awaiting_jobs(older_than_sec, limit=20):
+    """Задачи awaiting_provider без движения дольше older_than_sec: (filename, operation_id)."""
+    with db_cursor() as cur:
+        cur.execute(
+            """SELECT filename, operation_id FROM processed_files
+               WHERE status='awaiting_provider' AND updated_at < NOW() - make_interval(secs => %s)
+               ORDER BY updated_at LIMIT %s""",
+            (older_than_sec, limit)
+        )
+        return cur.fetchall()
+
+
+def release_leases():
+    """Graceful shutdown: свои незавершённые задачи сразу обратно в очередь."""
+    with db_cursor() as cur:
+        cur.execute(
+            """UPDATE processed_files
+               SET status='queued', lease_owner=NULL, lease_expires_at=NULL
+               WHERE lease_owner=%s AND status='transcribing'
+               RETURNING filename""",
+            (WORKER_ID,)
+        )
+        return [r[0] for r in cur.fetchall()]
+
+
+# ── Аудио (ffmpeg) ──────────────────────────────────────────────────────────────────────────
+
+# 16 kHz моно Opus 16 kbps — формат, который принимает SpeechKit sync API
+OPUS_ARGS = ['-vn', '-acodec', 'libopus', '-b:a', '16k', '-ac', '1', '-ar', '16000']
+
+
+FFMPEG_SLOTS = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+
+async def run_ffmpeg(cmd):
+    """ffmpeg в слоте FFMPEG_SLOTS до FFMPEG_TIMEOUT_SEC. Возвращает (rc, stderr)."""
+    async with FFMPEG_SLOTS:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+        try:
+            async with asyncio.timeout(FFMPEG_TIMEOUT_SEC):
+                _, err = await proc.communicate()
+        except TimeoutError:
+            raise RuntimeError(f'ffmpeg timeout after {FFMPEG_TIMEOUT_SEC}s') from None
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+    return proc.returncode, err.decode(errors='replace')
+
+
+async def probe_duration(filepath):
+    """Длительность по заголовку контейнера (ffprobe); None — неизвестна (webm от Jibri без Duration)."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', filepath,
+            stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL
+        )
+        try:
+            async with asyncio.timeout(30):
+                out, _ = await proc.communicate()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        return float(out.strip())
+    except (ValueError, OSError, TimeoutError):
+        return None
+
+
+async def transcode_to_opus(filepath, out):
+    """Весь файл → OGG Opus с теми же параметрами, что у чанков SpeechKit."""
+    with STAGES.timer('transcode'):
+        rc, err = await run_ffmpeg(['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', filepath, *OPUS_ARGS, out, '-y'])
+    if rc != 0:
+        raise RuntimeError(f'ffmpeg error (rc={rc}): {err[-500:]}')
+    return out
+
+
+@asynccontextmanager
+async def upload_source(filepath, filename, provider):
+    """
+    Путь к файлу для загрузки провайдеру: Opus-копия, если провайдер в
+    PRETRANSCODE_PROVIDERS, файл не меньше PRETRANSCODE_MIN_BYTES и копия
+    получилась меньше; иначе — исходник. Логирует объём загрузки и время ffmpeg.
+    """
+    size = os.path.getsize(filepath)
+    ext = filepath.rsplit('.', 1)[-1].lower()
+    if provider not in PRETRANSCODE_PROVIDERS or size < PRETRANSCODE_MIN_BYTES or ext in ('ogg', 'opus'):
+        log(f'UPLOAD: {filename} {size / 1e6:.1f} MB (original)')
+        yield filepath
+        return
+
+    td = tempfile.mkdtemp()
+    try:
+        start = time.monotonic()
+        try:
+            out = await transcode_to_opus(filepath, os.path.join(td, 'a.ogg'))
+        except Exception as e:
+            log(f'PRE-TRANSCODE ERR: {filename}: {e} — uploading original')
+            out = None
+        took = time.monotonic() - start
+        new_size = os.path.getsize(out) if out else size
+        if out and new_size < size:
+            log(f'UPLOAD: {filename} {new_size / 1e6:.1f} MB opus (original {size / 1e6:.1f} MB, '
+                f'saved {(size - new_size) / 1e6:.1f} MB, transcode {took:.1f}s)')
+            yield out
+        else:
+            log(f'UPLOAD: {filename} {size / 1e6:.1f} MB (original, transcode {took:.1f}s gave no gain)')
+            yield filepath
+    finally:
+        shutil.rmtree(td, ignore_errors=True)
+
+
+async def detect_speech(filepath):
+    """
+    VAD по энергии: ffmpeg silencedetect за один проход декодирования.
+    Возвращает (длительность, [(start, end), ...]) — участки речи
+    с полями VAD_PAD_SEC, пересекающиеся участки склеены.
+    """
+    cmd = ['ffmpeg', '-nostdin', '-i', filepath, '-vn', '-ac', '1', '-ar', '16000',
+           '-af', f'silencedetect=noise={VAD_NOISE_DB}dB:d={VAD_MIN_SILENCE_SEC}',
+           '-f', 'null', '-']
+    with STAGES.timer('vad'):
+        rc, err = await run_ffmpeg(cmd)
+    if rc != 0:
+        raise RuntimeError(f'ffmpeg silencedetect error (rc={rc}): {err[-500:]}')
+
+    # Длительность — по последней строке прогресса: у webm от Jibri Duration часто N/A
+    times = re.findall(r'time=(\d+):(\d+):(\d+(?:\.\d+)?)', err)
+    if not times:
+        return 0.0, []
+    h, m, sec = times[-1]
+    duration = int(h) * 3600 + int(m) * 60 + float(sec)
 
-# Whisper self-hosted (faster-whisper HTTP API, напр. http://whisper:9000)
-WHISPER_URL = os.getenv('WHISPER_URL', 'http://whisper:9000')
+    speech, pos, start = [], 0.0, None
+    for kind, t in re.findall(r'silence_(start|end): (-?[\d.]+)', err):
+        t = max(0.0, float(t))
+        if kind == 'start':
+            start = t
+        elif start is not None:
+            if start > pos:
+                speech.append((pos, start))
+            pos, start = t, None
+    end = start if start is not None else duration
+    if end > pos:
+        speech.append((pos, end))
 
-# AssemblyAI
-ASSEMBLYAI_API_KEY = os.getenv('ASSEMBLYAI_API_KEY', '')
-ASSEMBLYAI_UPLOAD_URL = 'https://api.assemblyai.com/v2/upload'
-ASSEMBLYAI_TRANSCRIPT_URL = 'https://api.assemblyai.com/v2/transcript'
+    regions = []
+    for a, b in speech:
+        a, b = max(0.0, a - VAD_PAD_SEC), min(duration, b + VAD_PAD_SEC)
+        if regions and a <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], b))
+        elif b > a:
+            regions.append((a, b))
+    return duration, regions
 
 
-def build_db_dsn():
-    dsn = os.getenv('DB_DSN', '')
-    if dsn:
-        return dsn
-    host = os.getenv('POSTGRES_HOST', 'postgres')
-    port = os.getenv('POSTGRES_PORT', '5432')
-    dbname = os.getenv('POSTGRES_DB', 'n8n')
-    user = os.getenv('POSTGRES_USER', 'n8n')
-    password = os.getenv('POSTGRES_PASSWORD', '')
-    return f"host={host} port={port} dbname={dbname} user={user} password={password}"
+def pack_speech(regions, max_sec):
+    """
+    Упаковывает участки речи в чанки длиной до max_sec, границы — по паузам.
+    Участок длиннее max_sec режется на куски по max_sec, остаток идёт в следующий чанк.
+    Возвращает список чанков, чанк — список (start, end) в секундах исходника.
+    """
+    chunks, cur, cur_len = [], [], 0.0
+    for a, b in regions:
+        while b - a > max_sec:
+            if cur:
+                chunks.append(cur)
+                cur, cur_len = [], 0.0
+            chunks.append([(a, a + max_sec)])
+            a += max_sec
+        if cur_len + (b - a) > max_sec:
+            chunks.append(cur)
+            cur, cur_len = [], 0.0
+        cur.append((a, b))
+        cur_len += b - a
+    if cur:
+        chunks.append(cur)
+    return chunks
 
 
-DB_DSN = build_db_dsn()
+def billed_seconds(durations, unit=SPEECHKIT_BILLING_SEC):
+    """Сколько секунд выставит провайдер: каждый запрос округляется вверх до unit."""
+    return sum(math.ceil(d / unit) * unit for d in durations if d > 0)
 
 
-# ── Утилиты ─────────────────────────────────────────────────────────────────────────────────
+def fixed_chunk_durations(duration, chunk_sec):
+    full, rest = divmod(duration, chunk_sec)
+    return [chunk_sec] * int(full) + ([rest] if rest > 0 else [])
 
-def log(msg):
-    ts = time.strftime('%Y-%m-%d %H:%M:%S')
-    line = f'[{ts}] [{STT_PROVIDER.upper()}] {msg}'
-    print(line, flush=True)
-    try:
-        with open('/tmp/ts.log', 'a') as f:
-            f.write(line + '\n')
-    except Exception:
-        pass
 
+async def convert_to_ogg_chunks(filepath, tmpdir, chunk_sec=SPEECHKIT_CHUNK_SEC, plan=None):
+    """
+    Async-генератор: конвертирует в OGG Opus и режет на чанки за один проход ffmpeg.
+    Список сегментов идёт в stdout (segment_list → pipe), поэтому путь к чанку
+    отдаётся, как только ffmpeg его закрыл: распознавание первых чанков
+    идёт параллельно с кодированием следующих.
+    plan — чанки из pack_speech(): паузы между участками вырезаются (aselect),
+    разрезы — по границам чанков; без plan — каждые chunk_sec секунд.
+    """
+    cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', filepath]
+    if plan is None:
+        cmd += [*OPUS_ARGS, '-f', 'segment', '-segment_time', str(chunk_sec)]
+    else:
+        spans = '+'.join(f'between(t,{a:.3f},{b:.3f})' for chunk in plan for a, b in chunk)
+        cmd += ['-af', f"aselect='{spans}',asetpts=N/SR/TB", *OPUS_ARGS, '-f', 'segment']
+        cuts, pos = [], 0.0
+        for chunk in plan[:-1]:
+            pos += sum(b - a for a, b in chunk)
+            cuts.append(f'{pos:.3f}')
+        if cuts:
+            cmd += ['-segment_times', ','.join(cuts)]
+        else:
+            cmd += ['-segment_time', str(SPEECHKIT_MAX_CHUNK_SEC * 2)]
+    cmd += ['-reset_timestamps', '1', '-segment_list', 'pipe:1', '-segment_list_type', 'flat',
+            os.path.join(tmpdir, 'c_%03d.ogg'), '-y']
+    errlog_path = os.path.join(tmpdir, 'ffmpeg.log')
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FFMPEG_TIMEOUT_SEC
+    async with FFMPEG_SLOTS:
+        with open(errlog_path, 'wb') as errlog, STAGES.timer('segment'):
+            proc = await asyncio.create_subprocess_exec(*cmd, stdin=DEVNULL, stdout=PIPE, stderr=errlog)
+            try:
+                while line := await asyncio.wait_for(proc.stdout.readline(), deadline - loop.time()):
+                    name = line.decode().strip()
+                    if name:
+                        yield os.path.join(tmpdir, name)
+                rc = await asyncio.wait_for(proc.wait(), max(0.0, deadline - loop.time()))
+            except TimeoutError:
+                raise RuntimeError(f'ffmpeg timeout after {FFMPEG_TIMEOUT_SEC}s') from None
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+    if rc != 0:
+        with open(errlog_path, 'rb') as f:
+            err = f.read()[-500:].decode(errors='replace')
+        raise RuntimeError(f'ffmpeg error (rc={rc}): {err}')
 
-def resolve_filepath(filepath):
-    if not filepath:
-        return filepath
-    if os.path.exists(filepath):
-        return filepath
-    if filepath.startswith('/recordings/'):
-        alt = filepath.replace('/recordings/', '/mnt/recordings/', 1)
-        if os.path.exists(alt):
-            return alt
-    return filepath
 
+# ── Провайдер: SpeechKit (Yandex) ─────────────────────────────────────────────────────────
 
-def db_update(filename, status, transcript=None):
-    try:
-        conn = psycopg2.connect(DB_DSN)
-        cur = conn.cursor()
-        if transcript is not None:
-            cur.execute(
-                'UPDATE processed_files SET status=%s, transcript_text=%s WHERE filename=%s',
-                (status, transcript, filename)
-            )
-        else:
-            cur.execute(
-                'UPDATE processed_files SET status=%s WHERE filename=%s',
-                (status, filename)
-            )
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        log(f'DB ERR: {e}')
+SPEECHKIT_SLOTS = asyncio.Semaphore(SPEECHKIT_CONCURRENCY)
+SPEECHKIT_LIMITER = TokenBucket(SPEECHKIT_RPS)
 
 
-def convert_to_ogg_chunks(filepath, tmpdir, chunk_sec=25):
-    """Converts audio to OGG Opus and splits into chunks."""
-    ogg = tmpdir + '/a.ogg'
-    subprocess.run(['ffmpeg', '-i', filepath, '-vn', '-acodec', 'libopus', '-b:a', '16k', '-ac', '1', '-ar', '16000', ogg, '-y'], capture_output=True, timeout=300)
-    subprocess.run(
-        ['ffmpeg', '-i', ogg, '-f', 'segment',
-         '-segment_time', str(chunk_sec), '-c', 'copy',
-         tmpdir + '/c_%03d.ogg', '-y'],
-        capture_output=True, timeout=60
-    )
-    return sorted([tmpdir + '/' + f for f in os.listdir(tmpdir) if f.startswith('c_')])
+async def recognize_speechkit_chunk(path):
+    """Один чанк → sync recognize. Общий лимит запросов + retry с backoff. Файл чанка удаляется."""
+    url = SPEECHKIT_URL + '?lang=ru-RU&format=oggopus&sampleRateHertz=16000'
+    headers = {'Authorization': 'Api-Key ' + YANDEX_API_KEY}
 
+    async def call():
+        await SPEECHKIT_LIMITER.acquire()
+        return await BREAKERS['speechkit'].call(lambda: http_post(url, audio, headers, timeout=30))
+
+    async with SPEECHKIT_SLOTS:
+        with open(path, 'rb') as f:
+            audio = f.read()
+        os.remove(path)
+        with STAGES.timer('recognize'):
+            body = await with_retries(call, SPEECHKIT_RETRIES)
+    return json.loads(body).get('result', '')
 
-# ── Провайдер: SpeechKit (Yandex) ─────────────────────────────────────────────────────────
 
-def transcribe_speechkit(filepath, filename):
+async def transcribe_speechkit(filepath, filename, content_hash=None, tracked=True):
     """
     Тарификация: каждые 15 сек аудио (округление вверх), 0.60₽/мин.
     Кодек и количество слов не влияют на цену — только длительность.
-    Нарезаем на 25-секундные чанки для sync API.
+    VAD: паузы не отправляем (их тоже тарифицируют), речь пакуем в чанки
+    до SPEECHKIT_MAX_CHUNK_SEC с разрезом по паузам; экономия пишется
+    в processed_files.billed_seconds_saved. Без VAD — чанки по 25 сек.
+    Чанк уходит на распознавание сразу, как ffmpeg его закрыл; запросы идут
+    параллельно (SPEECHKIT_CONCURRENCY, SPEECHKIT_RPS), результаты — по порядку.
+    Каждый распознанный чанк сохраняется в transcript_chunks (по content_hash файла):
+    после рестарта распознаются только недостающие чанки.
+    Сегменты — по чанкам, с их offsets в исходной записи.
     """
     if not YANDEX_API_KEY:
         raise RuntimeError('YANDEX_API_KEY is not set')
 
+    plan, duration = None, None
+    if VAD_ENABLED:
+        duration, speech = await detect_speech(filepath)
+        plan = pack_speech(speech, SPEECHKIT_MAX_CHUNK_SEC)
+        durations = [sum(b - a for a, b in chunk) for chunk in plan]
+        billed = billed_seconds(durations)
+        fixed = billed_seconds(fixed_chunk_durations(duration, SPEECHKIT_CHUNK_SEC))
+        log(f'VAD: {filename} speech {sum(durations):.0f}/{duration:.0f}s, {len(plan)} chunks, '
+            f'billed {billed}s (fixed chunks: {fixed}s, saved {fixed - billed}s)')
+        if tracked:
+            await blocking(db_set, filename, audio_seconds=duration, billed_seconds=billed,
+                           billed_seconds_saved=fixed - billed)
+        METRICS.inc('transcribe_billed_seconds_total', billed, provider='speechkit')
+        if not plan:
+            return '', []
+    else:
+        duration = await probe_duration(filepath)
+
+    plan_id = chunk_plan_id(plan, SPEECHKIT_CHUNK_SEC)
+    stored = await blocking(load_chunks, content_hash, plan_id) if content_hash else {}
+    if stored:
+        log(f'RESUME: {filename} {len(stored)} chunks from checkpoint')
+    total = len(plan) if plan else (math.ceil(duration / SPEECHKIT_CHUNK_SEC) if duration else None)
+    finished = len(stored)
+
+    def span(index):
+        if plan:
+            if index < len(plan):
+                return plan[index][0][0], plan[index][-1][1]
+            # ffmpeg выдал чанков больше плана (округление разрезов) — лишний чанк
+            # лежит в хвосте последнего участка речи
+            end = plan[-1][-1][1]
+            return end, end
+        end = (index + 1) * SPEECHKIT_CHUNK_SEC
+        return index * SPEECHKIT_CHUNK_SEC, min(end, duration) if duration else end
+
+    async def recognize(index, path):
+        nonlocal finished
+        if index in stored:
+            os.remove(path)
+            return stored[index]
+        text = await recognize_speechkit_chunk(path)
+        finished += 1
+        if content_hash:
+            start, end = span(index)
+            progress = round(min(99.0, 100 * finished / total), 1) if total and tracked else None
+            with STAGES.timer('db_write'):
+                await blocking(save_chunk, filename, content_hash, plan_id, index, start, end, text,
+                               'speechkit', progress)
+        return text
+
     td = tempfile.mkdtemp()
     try:
-        chunks = convert_to_ogg_chunks(filepath, td)
-        texts = []
-        for c in chunks:
-            with open(c,'rb') as f: audio = f.read()
-            req = urllib.request.Request(
-                'https://stt.api.cloud.yandex.net/speech/v1/stt:recognize'
-                '?lang=ru-RU&format=oggopus&sampleRateHertz=16000',
-                data=audio,
-                headers={'Authorization': 'Api-Key ' + YANDEX_API_KEY},
-                method='POST'
-            )
-            try:
-                r = urllib.request.urlopen(req, timeout=30)
-                texts.append(json.loads(r.read()).get('result', ''))
-            except Exception as e:
-                log(f'SpeechKit chunk err: {e}')
-            time.sleep(0.3)
-        return ' '.join(t for t in texts if t)
+        tasks = []
+        try:
+            async with aclosing(convert_to_ogg_chunks(filepath, td, plan=plan)) as chunks:
+                async for c in chunks:
+                    tasks.append(asyncio.create_task(recognize(len(tasks), c)))
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            raise
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        failed = [(i, r) for i, r in enumerate(results) if isinstance(r, BaseException)]
+        for i, err in failed:
+            log(f'SpeechKit chunk err: {filename} #{i}: {err}')
+        if len(failed) > SPEECHKIT_MAX_FAILED_CHUNKS * len(results):
+            unavailable = [e for _, e in failed if isinstance(e, ProviderUnavailable)]
+            if unavailable:
+                raise unavailable[0]
+            raise RuntimeError(f'SpeechKit: {len(failed)} of {len(results)} chunks failed: {failed[0][1]}')
+        segments = [{'start': span(i)[0], 'end': span(i)[1], 'speaker': None, 'text': r}
+                    for i, r in enumerate(results) if r and not isinstance(r, BaseException)]
+        return ' '.join(seg['text'] for seg in segments), segments
     finally:
         shutil.rmtree(td, ignore_errors=True)
 
 
 # ── Провайдер: Whisper (faster-whisper HTTP) ─────────────────────────────────────────────────
 
-def transcribe_whisper(filepath, filename):
+async def transcribe_whisper(filepath, filename, content_hash=None, tracked=True):
     """
     Отправляет файл на faster-whisper HTTP сервис (WHISPER_URL).
     Совместим с: faster-whisper-server, whisper.cpp server, openai-whisper-api-server.
+    Файл отправляется потоком (multipart по блокам), целиком в память не читается;
+    крупные файлы предварительно сжимаются в Opus (upload_source).
+    response_format=verbose_json — вместе с текстом приходят сегменты с таймингами.
+    429 / 5xx / сетевые ошибки — повтор с backoff (WHISPER_RETRIES), тело multipart — заново.
     """
-    with open(filepath, 'rb') as f:
-        audio_data = f.read()
-
     boundary = '----TranscribeBoundary'
-    ext = filepath.rsplit('.', 1)[-1].lower()
-    mime = {
-        'ogg': 'audio/ogg', 'webm': 'audio/webm', 'mp3': 'audio/mpeg',
-        'wav': 'audio/wav', 'm4a': 'audio/mp4'
-    }.get(ext, 'application/octet-stream')
+    async with upload_source(filepath, filename, 'whisper') as src:
+        if src != filepath:
+            filename = os.path.splitext(filename)[0] + '.ogg'
+        ext = src.rsplit('.', 1)[-1].lower()
+        mime = {
+            'ogg': 'audio/ogg', 'webm': 'audio/webm', 'mp3': 'audio/mpeg',
+            'wav': 'audio/wav', 'm4a': 'audio/mp4'
+        }.get(ext, 'application/octet-stream')
 
-    body = (
-        f'--{boundary}\r\n'
-        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
-        f'Content-Type: {mime}\r\n\r\n'
-    ).encode() + audio_data + f'\r\n--{boundary}\r\n'.encode() + (
-        f'Content-Disposition: form-data; name="language"\r\n\r\nru\r\n'
-        f'--{boundary}--\r\n'
-    ).encode()
+        def call():
+            length, body = multipart_file_body(boundary, 'file', src, filename, mime,
+                                               fields=[('language', 'ru'), ('response_format', 'verbose_json')])
+            return BREAKERS['whisper'].call(lambda: http_post(
+                WHISPER_URL + '/v1/audio/transcriptions', body,
+                {'Content-Type': f'multipart/form-data; boundary={boundary}', 'Content-Length': str(length)},
+                timeout=600
+            ))
+
+        with STAGES.timer('recognize'):
+            result = await with_retries(call, WHISPER_RETRIES)
+    data = json.loads(result)
+    segments = [{'start': seg['start'], 'end': seg['end'], 'speaker': None, 'text': seg['text'].strip()}
+                for seg in data.get('segments') or [] if seg.get('text', '').strip()]
+    return data.get('text', '').strip(), segments
+
+
+# ── Провайдер: local_whisper (faster-whisper в процессе) ───────────────────────────────────────
+
+class LocalWhisper:
+    """
+    Модель faster-whisper, загруженная один раз (load() в отдельном потоке при старте).
+    Распознавание — в своём пуле из LOCAL_WHISPER_WORKERS потоков: CTranslate2
+    отпускает GIL, event loop и остальные задачи не ждут. faster-whisper —
+    необязательная зависимость (Dockerfile: --build-arg LOCAL_WHISPER=1).
+    """
+
+    def __init__(self):
+        self.model = None
+        self.error = None
+        self.executor = ThreadPoolExecutor(max_workers=LOCAL_WHISPER_WORKERS, thread_name_prefix='local-whisper')
+
+    def load(self):
+        start = time.monotonic()
+        try:
+            from faster_whisper import WhisperModel
+            self.model = WhisperModel(
+                LOCAL_WHISPER_MODEL, device='cpu', compute_type=LOCAL_WHISPER_COMPUTE_TYPE,
+                cpu_threads=LOCAL_WHISPER_THREADS, num_workers=LOCAL_WHISPER_WORKERS,
+                download_root=LOCAL_WHISPER_MODEL_DIR
+            )
+            log(f'LOCAL WHISPER: {LOCAL_WHISPER_MODEL} ({LOCAL_WHISPER_COMPUTE_TYPE}) loaded in '
+                f'{time.monotonic() - start:.0f}s, {LOCAL_WHISPER_WORKERS}×{LOCAL_WHISPER_THREADS} threads')
+        except Exception as e:
+            self.error = str(e) or repr(e)
+            log(f'LOCAL WHISPER ERR: {self.error}')
+
+    def state(self):
+        return 'error' if self.error else ('loaded' if self.model else 'loading')
 
-    req = urllib.request.Request(
-        WHISPER_URL + '/v1/audio/transcriptions',
-        data=body,
-        headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
-        method='POST'
-    )
-    r = urllib.request.urlopen(req, timeout=600)
-    result = json.loads(r.read())
-    return result.get('text', '')
+    def run(self, filepath):
+        from faster_whisper import BatchedInferencePipeline
+        # Пайплайн дешёвый, но хранит состояние между батчами — свой на каждый файл
+        pipeline = BatchedInferencePipeline(model=self.model)
+        segments, _ = pipeline.transcribe(filepath, language='ru', batch_size=LOCAL_WHISPER_BATCH,
+                                          vad_filter=True)
+        result = [{'start': seg.start, 'end': seg.end, 'speaker': None, 'text': seg.text.strip()}
+                  for seg in segments if seg.text.strip()]
+        return ' '.join(seg['text'] for seg in result), result
+
+    def as_dict(self):
+        return {'model': LOCAL_WHISPER_MODEL, 'compute_type': LOCAL_WHISPER_COMPUTE_TYPE,
+                'workers': LOCAL_WHISPER_WORKERS, 'threads': LOCAL_WHISPER_THREADS,
+                'batch': LOCAL_WHISPER_BATCH, 'state': self.state(), 'error': self.error}
+
+
+LOCAL_WHISPER = LocalWhisper()
+
+
+async def transcribe_local_whisper(filepath, filename, content_hash=None, tracked=True):
+    """
+    faster-whisper в процессе: без HTTP и отдельного контейнера. VAD-сегменты файла
+    идут в модель батчами (BatchedInferencePipeline), файлы — параллельно в LOCAL_WHISPER_WORKERS.
+    Пока модель грузится — ProviderUnavailable: задача вернётся в очередь с задержкой.
+    """
+    if LOCAL_WHISPER.error:
+        raise RuntimeError(f'local_whisper model failed to load: {LOCAL_WHISPER.error}')
+    if LOCAL_WHISPER.model is None:
+        raise ProviderUnavailable('local_whisper', 30, 'model loading')
+    loop = asyncio.get_running_loop()
+    with STAGES.timer('recognize'):
+        return await loop.run_in_executor(LOCAL_WHISPER.executor, LOCAL_WHISPER.run, filepath)
 
 
 # ── Провайдер: AssemblyAI ────────────────────────────────────────────────────────────────────────────────
 
-def transcribe_assemblyai(filepath, filename):
+class JobDeferred(Exception):
+    """Провайдер принял задачу асинхронно — воркер освобождается, результат придёт позже."""
+
+
+def assemblyai_result(data):
+    """Готовый транскрипт AssemblyAI → (text, segments) из таймингов слов."""
+    return data.get('text') or '', segments_from_words(data.get('words') or [])
+
+
+async def assemblyai_call(fn):
+    """Запрос к AssemblyAI под breaker'ом, с повторами при 429 / 5xx / сетевых ошибках."""
+    return await with_retries(lambda: BREAKERS['assemblyai'].call(fn), ASSEMBLYAI_RETRIES)
+
+
+async def assemblyai_get(transcript_id):
+    return await assemblyai_call(lambda: http_get_json(
+        f'{ASSEMBLYAI_TRANSCRIPT_URL}/{transcript_id}', {'authorization': ASSEMBLYAI_API_KEY}))
+
+
+def assemblyai_poll_delays(duration):
+    """
+    Паузы между опросами. Длительность известна: первый опрос — на половине
+    ожидаемого времени (5 с + ASSEMBLYAI_RTF × длительность), дальше шаг растёт ×1.5.
+    Неизвестна: с 5 с и тем же ростом. Шаг ограничен ASSEMBLYAI_POLL_MAX_SEC, jitter ±20%.
+    """
+    if duration:
+        expected = 5 + ASSEMBLYAI_RTF * duration
+        yield max(3.0, expected * 0.5) * random.uniform(0.8, 1.2)
+        step = max(3.0, expected * 0.1)
+    else:
+        step = 5.0
+    while True:
+        yield min(ASSEMBLYAI_POLL_MAX_SEC, step) * random.uniform(0.8, 1.2)
+        step *= 1.5
+
+
+async def transcribe_assemblyai(filepath, filename, content_hash=None, tracked=True):
     """
     AssemblyAI: ~$0.0025/мин (~0.23₽), поддержка русского.
-    Загружает файл → создаёт задачу → polling результата.
+    Загружает файл (потоком) → создаёт задачу → ждёт результат:
+    адаптивный polling по длительности записи или, при ASSEMBLYAI_WEBHOOK_BASE_URL,
+    webhook (JobDeferred — воркер свободен, пока AssemblyAI работает). Webhook — только
+    для задач очереди (tracked): его результат завершает строку processed_files.
     """
     if not ASSEMBLYAI_API_KEY:
         raise RuntimeError('ASSEMBLYAI_API_KEY is not set')
 
     headers = {'authorization': ASSEMBLYAI_API_KEY}
 
-    # 1. Upload file
-    with open(filepath, 'rb') as f:
-        req = urllib.request.Request(
-            ASSEMBLYAI_UPLOAD_URL,
-            data=f.read(),
-            headers={**headers, 'content-type': 'application/octet-stream'},
-            method='POST'
-        )
-        r = urllib.request.urlopen(req, timeout=120)
-        upload_url = json.loads(r.read())['upload_url']
+    # 1. Upload file (потоком, блоками по UPLOAD_BLOCK; крупные — после сжатия в Opus)
+    async with upload_source(filepath, filename, 'assemblyai') as src:
+        duration = await probe_duration(src)
+        with STAGES.timer('upload'):
+            r = await assemblyai_call(lambda: http_post(
+                ASSEMBLYAI_UPLOAD_URL, iter_file_blocks(src),
+                {**headers, 'content-type': 'application/octet-stream', 'content-length': str(os.path.getsize(src))},
+                timeout=120
+            ))
+        upload_url = json.loads(r)['upload_url']
 
     # 2. Submit transcription
-    payload = json.dumps({
+    params = {
         'audio_url': upload_url,
         'language_code': 'ru',
         'punctuate': True,
         'format_text': True
-    }).encode()
-    req = urllib.request.Request(
-        ASSEMBLYAI_TRANSCRIPT_URL,
-        data=payload,
-        headers={**headers, 'content-type': 'application/json'},
-        method='POST'
-    )
-    r = urllib.request.urlopen(req, timeout=30)
-    transcript_id = json.loads(r.read())['id']
-
-    # 3. Poll until completed
-    poll_url = f'{ASSEMBLYAI_TRANSCRIPT_URL}/{transcript_id}'
-    for attempt in range(60):  # max 10 минут
-        time.sleep(10)
-        req = urllib.request.Request(poll_url, headers=headers)
-        r = urllib.request.urlopen(req, timeout=15)
-        data = json.loads(r.read())
-        status = data.get('status')
-        if status == 'completed':
-            return data.get('text', '')
-        if status == 'error':
-            raise RuntimeError(f'AssemblyAI error: {data.get("error")}')
-
-    raise RuntimeError('AssemblyAI timeout after 10 minutes')
+    }
+    if DIARIZATION:
+        params['speaker_labels'] = True
+    deferred = is_deferred_provider('assemblyai', tracked)
+    if deferred:
+        params['webhook_url'] = (ASSEMBLYAI_WEBHOOK_BASE_URL + '/webhooks/assemblyai?filename='
+                                 + urllib.parse.quote(filename))
+        params['webhook_auth_header_name'] = 'X-Webhook-Secret'
+        params['webhook_auth_header_value'] = ASSEMBLYAI_WEBHOOK_SECRET
+    r = await assemblyai_call(lambda: http_post(
+        ASSEMBLYAI_TRANSCRIPT_URL, json.dumps(params).encode(),
+        {**headers, 'content-type': 'application/json'}, timeout=30))
+    transcript_id = json.loads(r)['id']
+
+    if deferred:
+        await blocking(defer_job, filename, transcript_id)
+        raise JobDeferred(f'AssemblyAI {transcript_id}: waiting for webhook')
+
+    # 3. Poll until completed (адаптивно по длительности записи)
+    timeout = max(600, 4 * (5 + ASSEMBLYAI_RTF * duration)) if duration else 1800
+    deadline = time.monotonic() + timeout
+    polls = 0
+    with STAGES.timer('recognize'):
+        for delay in assemblyai_poll_delays(duration):
+            if time.monotonic() + delay > deadline:
+                break
+            await asyncio.sleep(delay)
+            polls += 1
+            try:
+                data = await assemblyai_get(transcript_id)
+            except (HTTPStatusError, httpx.TransportError, OSError, ProviderUnavailable) as e:
+                # Задача уже принята и оплачена — сбой опроса не повод её бросать
+                if not (isinstance(e, ProviderUnavailable) or is_transient(e)):
+                    raise
+                log(f'AssemblyAI poll ERR: {filename}: {e} — next poll')
+                continue
+            status = data.get('status')
+            if status == 'completed':
+                log(f'AssemblyAI: {filename} ready after {polls} polls (audio {duration or 0:.0f}s)')
+                return assemblyai_result(data)
+            if status == 'error':
+                raise RuntimeError(f'AssemblyAI error: {data.get("error")}')
+
+    raise RuntimeError(f'AssemblyAI timeout after {timeout:.0f}s')
+
+
+async def complete_assemblyai(filename, transcript_id):
+    """
+    Webhook / сверка: забирает результат AssemblyAI и завершает отложенную задачу.
+    Завершается только задача в awaiting_provider с тем же operation_id.
+    Возвращает False, если AssemblyAI ещё не закончил.
+    """
+    data = await assemblyai_get(transcript_id)
+    status = data.get('status')
+    if status not in TERMINAL_STATUSES:
+        return False
+    row = await blocking(job_status, filename)
+    if not row or row[0] != 'awaiting_provider' or row[2] != transcript_id:
+        log(f'AssemblyAI webhook: {filename} is {row[0] if row else "not_found"} '
+            f'({row[2] if row else None}), {transcript_id} skipped')
+        return True
+    if status == 'error':
+        log(f'ERR: {filename}: AssemblyAI error: {data.get("error")}')
+        await blocking(finish_job, filename, 'error', error=f'AssemblyAI error: {data.get("error")}')
+        METRICS.inc('transcribe_jobs_total', provider='assemblyai', status='error')
+        return True
+    text, segments = assemblyai_result(data)
+    await blocking(finish_job, filename, 'completed', text, segments=segments)
+    METRICS.inc('transcribe_jobs_total', provider='assemblyai', status='completed')
+    log(f'DONE: {filename} -> {len(text)} chars (AssemblyAI {transcript_id})')
+    if row[1] and text:
+        await blocking(cache_store, row[1], None, text, segments, 'assemblyai')
+    return True
+
+
+async def reconcile_awaiting():
+    """Страховка от потерянного webhook: давно ждущие задачи проверяем опросом."""
+    for filename, transcript_id in await blocking(stale_awaiting_jobs, ASSEMBLYAI_WEBHOOK_CHECK_SEC):
+        try:
+            if not await complete_assemblyai(filename, transcript_id):
+                # updated_at → следующая сверка позже
+                await blocking(db_set, filename, operation_id=transcript_id)
+        except Exception as e:
+            log(f'AssemblyAI reconcile ERR: {filename}: {e}')
+
+
+# ── Диаризация (локальная) ────────────────────────────────────────────────────────────────────
+# Кадры по 0.5 с → форма спектра (энергии полос в дБ минус громкость кадра); эмбеддинг
+# сегмента — среднее по озвученным кадрам; сегменты кластеризуются агломеративно.
+# Разметка на уровне сегментов: у SpeechKit сегмент — чанк до 30 с, поэтому грубее.
+
+DIARIZATION_RATE = 8000
+DIARIZATION_FRAME_SEC = 0.5
+DIARIZATION_BANDS = 24
+
+
+def import_numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+
+# Локальная разметка только для провайдеров с сегментами уровня реплики. У SpeechKit сегмент —
+# VAD-чанк до 30 с (без таймингов слов): метка на чанк склеила бы реплики разных говорящих
+LOCAL_DIARIZATION_PROVIDERS = ('whisper', 'local_whisper')
+
+
+def has_speakers(segments):
+    return any(seg.get('speaker') for seg in segments)
+
+
+def needs_diarization(provider, segments):
+    """DIARIZATION=1, провайдер не разметил сам и его сегменты — уровня реплики."""
+    return (DIARIZATION and provider in LOCAL_DIARIZATION_PROVIDERS
+            and bool(segments) and not has_speakers(segments))
+
+
+def spectral_frames(np, pcm):
+    """PCM s16le → (форма спектра [кадры × полосы], громкость кадра), дБ."""
+    n = int(DIARIZATION_RATE * DIARIZATION_FRAME_SEC)
+    x = np.frombuffer(pcm, '<i2').astype(np.float32).reshape(-1, n)
+    power = np.abs(np.fft.rfft(x * np.hanning(n), axis=1)) ** 2
+    edges = np.geomspace(80, DIARIZATION_RATE / 2 - 100, DIARIZATION_BANDS + 1)
+    band = np.digitize(np.fft.rfftfreq(n, 1 / DIARIZATION_RATE), edges) - 1
+    energy = np.stack([power[:, band == b].sum(axis=1) for b in range(DIARIZATION_BANDS)], axis=1)
+    logs = 10 * np.log10(energy + 1e-3)
+    loudness = logs.mean(axis=1)
+    return logs - loudness[:, None], loudness
+
+
+async def speaker_frames(np, filepath):
+    """Потоковое декодирование (8 kHz моно) → кадры spectral_frames; весь PCM в памяти не держим."""
+    frame_bytes = int(DIARIZATION_RATE * DIARIZATION_FRAME_SEC) * 2
+    shapes, loudness, buf = [], [], b''
+    async with FFMPEG_SLOTS:
+        proc = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-loglevel', 'error', '-i', filepath, '-vn',
+            '-ac', '1', '-ar', str(DIARIZATION_RATE), '-f', 's16le', 'pipe:1',
+            stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL
+        )
+        try:
+            async with asyncio.timeout(FFMPEG_TIMEOUT_SEC):
+                while block := await proc.stdout.read(frame_bytes * 120):
+                    buf += block
+                    whole = len(buf) // frame_bytes * frame_bytes
+                    if whole:
+                        shape, loud = await blocking(spectral_frames, np, buf[:whole])
+                        shapes.append(shape)
+                        loudness.append(loud)
+                        buf = buf[whole:]
+                rc = await proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+    if rc != 0:
+        raise RuntimeError(f'ffmpeg diarization decode error (rc={rc})')
+    if not shapes:
+        return np.zeros((0, DIARIZATION_BANDS)), np.zeros(0)
+    return np.concatenate(shapes), np.concatenate(loudness)
+
+
+def cluster_speakers(np, emb, threshold_db, max_speakers):
+    """
+    Агломеративная кластеризация (centroid linkage, RMS-разница спектров в дБ):
+    сливаем два ближайших кластера, пока разница меньше threshold_db
+    или кластеров больше max_speakers. Возвращает номер кластера для каждой строки emb.
+    """
+    n = len(emb)
+    centroids, sizes = emb.copy(), np.ones(n)
+    owner, alive = np.arange(n), np.ones(n, dtype=bool)
+    sq = (centroids ** 2).sum(axis=1)
+    dist = np.sqrt(np.maximum(sq[:, None] + sq[None] - 2 * centroids @ centroids.T, 0) / emb.shape[1])
+    np.fill_diagonal(dist, np.inf)
+    clusters = n
+    while clusters > 1:
+        i, j = np.unravel_index(np.argmin(dist), dist.shape)
+        if dist[i, j] >= threshold_db and clusters <= max_speakers:
+            break
+        centroids[i] = (centroids[i] * sizes[i] + centroids[j] * sizes[j]) / (sizes[i] + sizes[j])
+        sizes[i] += sizes[j]
+        owner[owner == j] = i
+        alive[j] = False
+        row = np.sqrt(((centroids - centroids[i]) ** 2).mean(axis=1))
+        row[~alive] = np.inf
+        row[i] = np.inf
+        dist[i, :] = dist[:, i] = row
+        dist[j, :] = dist[:, j] = np.inf
+        clusters -= 1
+    return owner
+
+
+async def diarize_segments(filepath, segments):
+    """Проставляет speaker (S1, S2, … в порядке появления) сегментам без разметки провайдера."""
+    np = import_numpy()
+    if np is None:
+        log('DIARIZATION: numpy is not installed, skipped')
+        return segments
+    shapes, loudness = await speaker_frames(np, filepath)
+    if not len(shapes):
+        return segments
+    voiced = loudness > np.percentile(loudness, 30)
+    emb, owners = [], []
+    for i, seg in enumerate(segments):
+        a = int(seg['start'] / DIARIZATION_FRAME_SEC)
+        b = int(math.ceil(seg['end'] / DIARIZATION_FRAME_SEC))
+        frames = shapes[a:b][voiced[a:b]]
+        if len(frames) >= 2:
+            emb.append(frames.mean(axis=0))
+            owners.append(i)
+    if len(emb) < 2:
+        return segments
+    clusters = await blocking(cluster_speakers, np, np.array(emb), DIARIZATION_THRESHOLD_DB,
+                              DIARIZATION_MAX_SPEAKERS)
+
+    names = {}
+    labels = dict(zip(owners, (names.setdefault(c, f'S{len(names) + 1}') for c in clusters.tolist())))
+    result, speaker = [], labels[owners[0]]
+    for i, seg in enumerate(segments):
+        speaker = labels.get(i, speaker)  # короткий сегмент без кадров — как у соседа слева
+        result.append({**seg, 'speaker': speaker})
+    return result
+
+
+# ── Завершение задач: long-poll и callback ──────────────────────────────────────────────────────
+
+TERMINAL_STATUSES = ('completed', 'error')
+
+
+class JobEvents:
+    """
+    Счётчик версий на имя файла + Condition. /check в режиме long-poll
+    запоминает версию до запроса в БД и ждёт её смены — завершение между
+    запросом и ожиданием не теряется. Запись живёт, пока файл кто-то
+    ждёт (watch): без ожидающих словарь не растёт.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._entries = {}  # filename -> [версия, ожидающих]
+
+    @contextmanager
+    def watch(self, filename):
+        with self._cond:
+            entry = self._entries.setdefault(filename, [0, 0])
+            entry[1] += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._entries[filename]
+
+    def version(self, filename):
+        with self._cond:
+            return self._entries[filename][0]
+
+    def notify(self, filename):
+        with self._cond:
+            entry = self._entries.get(filename)
+            if entry:
+                entry[0] += 1
+                self._cond.notify_all()
+
+    def wait(self, filename, version, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._entries[filename][0] != version, timeout)
+
+
+JOB_EVENTS = JobEvents()
+
+
+async def send_callback(url, payload):
+    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    try:
+        await with_retries(lambda: http_post(url, data, {'Content-Type': 'application/json'}, timeout=15),
+                           CALLBACK_RETRIES)
+        log(f'CALLBACK OK: {payload["filename"]} -> {url}')
+    except Exception as e:
+        log(f'CALLBACK ERR: {payload["filename"]} -> {url}: {e}')
+
+
+def finish_job(filename, status, transcript=None, error=None, segments=None):
+    """Финальный статус в БД + пробуждение long-poll /check + callback_url (на RUNNER)."""
+    with STAGES.timer('db_write'):
+        callback_url = db_update(filename, status, transcript, error, segments)
+    JOB_EVENTS.notify(filename)
+    if callback_url:
+        payload = {'filename': filename, 'status': status, 'transcript': transcript, 'error': error}
+        RUNNER.submit(send_callback(callback_url, payload))
+
+
+def check_transcript(filename, wait=0):
+    """(транскрипт, статус, прогресс %) из БД; при wait > 0 ждёт завершения задачи до wait секунд."""
+    deadline = time.monotonic() + min(wait, CHECK_MAX_WAIT_SEC)
+    with JOB_EVENTS.watch(filename):
+        while True:
+            version = JOB_EVENTS.version(filename)
+            with db_cursor() as cur:
+                cur.execute('SELECT transcript_text, status, progress FROM processed_files WHERE filename=%s',
+                            (filename,))
+                row = cur.fetchone()
+            remaining = deadline - time.monotonic()
+            if not row or row[0] or row[1] in TERMINAL_STATUSES or remaining <= 0:
+                return row
+            JOB_EVENTS.wait(filename, version, remaining)
 
 
 # ── Диспетчер провайдеров ──────────────────────────────────────────────────────────────────────────────
 
+# Провайдер: (filepath, filename, content_hash, tracked) → (text, segments).
+# content_hash — ключ чекпоинтов чанков (SpeechKit); tracked=False — задача не из processed_files
+# (пакетный CLI): служебные колонки не пишутся, AssemblyAI — опросом, без webhook
 PROVIDERS = {
     'speechkit': transcribe_speechkit,
     'whisper': transcribe_whisper,
+    'local_whisper': transcribe_local_whisper,
     'assemblyai': transcribe_assemblyai,
 }
 
 
-def transcribe_async(filepath, filename):
-    """Runs in a separate thread. Dispatches to the active STT provider."""
-    log(f'START: {filename} (provider={STT_PROVIDER})')
+# Априорная скорость, сек обработки на сек аудио — пока статистики меньше ROUTE_MIN_SAMPLES
+# (Whisper medium на CPU: 2:12 за ~5 мин; в процессе int8 с батчами — в разы быстрее)
+PROVIDER_PRIOR_RTF = {'speechkit': 0.1, 'whisper': 2.5, 'local_whisper': 0.8, 'assemblyai': 0.3}
+# Параллельность провайдера; нет в словаре — очередь на стороне провайдера не учитываем
+PROVIDER_CAPACITY = {'whisper': WHISPER_CAPACITY, 'local_whisper': LOCAL_WHISPER_WORKERS}
+ROUTE_MIN_SAMPLES = 5
+ROUTE_UNKNOWN_DURATION_SEC = 600  # длительность не определилась (webm от Jibri)
+HEDGE_MIN_BUDGET_SEC = 10
+
+
+class ProviderStats:
+    """Скользящая статистика провайдера в памяти: задачи в работе, ошибки, p95 задержки и RTF."""
+
+    WINDOW = 200
+
+    def __init__(self, name):
+        self.name = name
+        self.inflight = 0
+        self.ok = 0
+        self.errors = 0
+        self.hedges = 0
+        self.samples = collections.deque(maxlen=self.WINDOW)  # (задержка, длительность аудио)
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.inflight += 1
+
+    def end(self, latency, audio_sec, ok):
+        """ok=None — вызов отменён (проиграл hedging) или отложен: в статистику не идёт."""
+        with self._lock:
+            self.inflight -= 1
+            if ok:
+                self.ok += 1
+                self.samples.append((latency, audio_sec))
+            elif ok is not None:
+                self.errors += 1
+
+    @staticmethod
+    def _p95(values):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * 0.95))] if values else None
+
+    def rtf_p95(self):
+        with self._lock:
+            rtf = [lat / a for lat, a in self.samples if a]
+        if len(rtf) < ROUTE_MIN_SAMPLES:
+            return PROVIDER_PRIOR_RTF.get(self.name, 1.0)
+        return self._p95(rtf)
+
+    def expected_sec(self, duration):
+        """Ожидаемое время задачи с учётом очереди у провайдера (при ограниченной параллельности)."""
+        capacity = PROVIDER_CAPACITY.get(self.name)
+        waves = 1 + (self.inflight // capacity if capacity else 0)
+        return self.rtf_p95() * (duration or ROUTE_UNKNOWN_DURATION_SEC) * waves
+
+    def as_dict(self):
+        with self._lock:
+            latencies = [lat for lat, _ in self.samples]
+            done = self.ok + self.errors
+            info = {'inflight': self.inflight, 'ok': self.ok, 'errors': self.errors,
+                    'error_rate': round(self.errors / done, 3) if done else None,
+                    'hedges': self.hedges, 'samples': len(self.samples)}
+        p95 = self._p95(latencies)
+        info['p95_sec'] = round(p95, 2) if p95 is not None else None
+        info['rtf_p95'] = round(self.rtf_p95(), 3)
+        return info
+
+
+PROVIDER_STATS = {name: ProviderStats(name) for name in PROVIDERS}
+
+
+def route_candidates(duration):
+    """
+    Провайдеры из STT_ROUTES, которым подходит длительность файла, по возрастанию
+    ожидаемого времени; при равенстве — в порядке STT_ROUTES.
+    Длительность неизвестна — только провайдеры без ограничения max_sec.
+    Провайдеры с открытым circuit breaker пропускаются; открыты у всех — ProviderUnavailable.
+    """
+    scored, waits = [], []
+    for order, (name, max_sec) in enumerate(STT_ROUTES):
+        if name not in PROVIDERS:
+            raise RuntimeError(f'Unknown STT provider {name!r}. Allowed: {", ".join(PROVIDERS)}')
+        if max_sec is not None and (duration is None or duration > max_sec):
+            continue
+        wait = BREAKERS[name].retry_after()
+        if wait:
+            waits.append((wait, name))
+            continue
+        scored.append((PROVIDER_STATS[name].expected_sec(duration), order, name))
+    if not scored and waits:
+        wait, name = min(waits)
+        raise ProviderUnavailable(name, wait)
+    if not scored:
+        raise RuntimeError(f'No STT provider in STT_ROUTES for duration {duration}')
+    return [name for _, _, name in sorted(scored)]
+
+
+def routes_retry_after():
+    """Открыты breaker'ы всех провайдеров из STT_ROUTES — через сколько секунд повторить (иначе 0)."""
+    waits = [BREAKERS[name].retry_after() for name, _ in STT_ROUTES if name in BREAKERS]
+    return min(waits) if waits and all(waits) else 0
+
+
+def is_deferred_provider(name, tracked=True):
+    """Провайдер отпускает задачу до результата (AssemblyAI с webhook) — в hedging не участвует."""
+    return name == 'assemblyai' and bool(ASSEMBLYAI_WEBHOOK_BASE_URL) and tracked
+
+
+async def run_provider(name, filepath, filename, duration, content_hash=None, tracked=True):
+    stats = PROVIDER_STATS[name]
+    stats.begin()
+    start = time.monotonic()
+    ok = False
     try:
-        provider_fn = PROVIDERS.get(STT_PROVIDER)
-        if not provider_fn:
-            allowed = ', '.join(PROVIDERS.keys())
-            raise RuntimeError(
-                f'Unknown STT_PROVIDER={STT_PROVIDER!r}. Allowed: {allowed}'
-            )
-        result = provider_fn(filepath, filename)
-        db_update(filename, 'completed', result)
-        log(f'DONE: {filename} -> {len(result)} chars')
+        result = await PROVIDERS[name](filepath, filename, content_hash, tracked)
+        ok = True
+        return result
+    except (asyncio.CancelledError, JobDeferred, ProviderUnavailable):
+        ok = None
+        raise
+    finally:
+        stats.end(time.monotonic() - start, duration, ok)
+
+
+async def transcribe_routed(filepath, filename, content_hash=None, tracked=True):
+    """
+    Выбор провайдера на задачу (route_candidates) и, при STT_HEDGE=1, hedging:
+    если первый не ответил за STT_HEDGE_FACTOR × ожидаемое время, параллельно
+    запускается следующий кандидат; проигравший отменяется. Возвращает (provider, (text, segments)).
+    content_hash, tracked — передаются провайдеру (см. PROVIDERS).
+    """
+    duration = await probe_duration(filepath)
+    candidates = route_candidates(duration)
+    primary = candidates[0]
+    if len(STT_ROUTES) > 1:
+        log(f'ROUTE: {filename} ({duration or 0:.0f}s) -> {primary} (candidates: {", ".join(candidates)})')
+
+    backup = None
+    if STT_HEDGE and not is_deferred_provider(primary, tracked):
+        backup = next((c for c in candidates[1:] if not is_deferred_provider(c, tracked)), None)
+    if not backup:
+        return primary, await run_provider(primary, filepath, filename, duration, content_hash, tracked)
+
+    budget = max(HEDGE_MIN_BUDGET_SEC, STT_HEDGE_FACTOR * PROVIDER_STATS[primary].expected_sec(duration))
+    first = asyncio.create_task(run_provider(primary, filepath, filename, duration, content_hash, tracked))
+    done, _ = await asyncio.wait({first}, timeout=budget)
+    if done:
+        return primary, first.result()
+
+    log(f'HEDGE: {filename} {primary} > {budget:.0f}s, racing {backup}')
+    PROVIDER_STATS[backup].hedges += 1
+    second = asyncio.create_task(run_provider(backup, filepath, filename, duration, content_hash, tracked))
+    names = {first: primary, second: backup}
+    pending, error = {first, second}, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return names[task], task.result()
+                log(f'HEDGE: {filename} {names[task]} failed: {task.exception()}')
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def transcribe_job(filepath, filename):
+    """
+    Задача на RUNNER. Сначала — кэш по хешу содержимого,
+    при промахе — провайдер по маршрутизации (transcribe_routed).
+    True — STT отработал до конца (только такие задачи идут в STAGES job для оценки дедлайна).
+    """
+    log(f'START: {filename}')
+    try:
+        # Хеш содержимого — ключ кэша и чекпоинтов чанков
+        with STAGES.timer('hash'):
+            content_hash = await blocking(file_sha256, filepath)
+        await blocking(db_set, filename, content_hash=content_hash, progress=0)
+        await blocking(manifest_set_hash, filepath, content_hash)
+        pcm_hash = None
+        if TRANSCRIPT_CACHE:
+            pcm_hash = await pcm_fingerprint(filepath) if AUDIO_FINGERPRINT else None
+            cached = await blocking(cache_lookup, content_hash, pcm_hash)
+            CACHE_STATS.record(cached is not None)
+            if cached is not None:
+                text, columns = cached
+                await blocking(finish_job, filename, 'completed', text, segments=unpack_segments(columns))
+                METRICS.inc('transcribe_jobs_total', provider='cache', status='completed')
+                log(f'CACHE HIT: {filename} ({content_hash[:12]}) -> {len(text)} chars')
+                return
+
+        provider, (text, segments) = await transcribe_routed(filepath, filename, content_hash)
+        if needs_diarization(provider, segments):
+            try:
+                with STAGES.timer('diarize'):
+                    segments = await diarize_segments(filepath, segments)
+                log(f'DIARIZATION: {filename} {len({seg["speaker"] for seg in segments})} speakers')
+            except Exception as e:
+                log(f'DIARIZATION ERR: {filename}: {e}')
+        await blocking(db_set, filename, stt_provider=provider)
+        await blocking(finish_job, filename, 'completed', text, segments=segments)
+        METRICS.inc('transcribe_jobs_total', provider=provider, status='completed')
+        log(f'DONE: {filename} -> {len(text)} chars, {len(segments)} segments ({provider})')
+        await blocking(clear_chunks, content_hash)
+        if TRANSCRIPT_CACHE and text:
+            await blocking(cache_store, content_hash, pcm_hash, text, segments, provider)
+        return True
+    except JobDeferred as e:
+        METRICS.inc('transcribe_jobs_total', provider='assemblyai', status='deferred')
+        log(f'DEFERRED: {filename}: {e}')
+    except ProviderUnavailable as e:
+        METRICS.inc('transcribe_jobs_total', provider=e.provider, status='requeued')
+        log(f'BACKOFF: {filename}: {e}')
+        await blocking(requeue_job, filename, e.retry_after, str(e))
     except Exception as e:
-        log(f'ERR: {filename}: {e}')
-        db_update(filename, 'error')
+        error = str(e) or repr(e)
+        METRICS.inc('transcribe_jobs_total', provider='', status='error')
+        log(f'ERR: {filename}: {error}')
+        await blocking(finish_job, filename, 'error', error=error)
+
+
+class WorkerPool:
+    """
+    Диспетчер забирает задачи из processed_files, пока в работе меньше WORKERS,
+    и запускает их корутинами на RUNNER: задача, которая ждёт провайдера,
+    поток не занимает. Отдельный поток housekeeping продлевает аренду активных задач,
+    возвращает в очередь задачи с просроченной арендой и запускает на RUNNER
+    сверку задач, ждущих webhook AssemblyAI (не больше одного прохода сразу).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.active = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._slots = threading.Semaphore(size)
+        self._reconcile = None
+
+    def start(self):
+        threading.Thread(target=self._dispatcher, name='dispatcher', daemon=True).start()
+        threading.Thread(target=self._housekeeper, name='housekeeper', daemon=True).start()
+
+    def notify(self):
+        """Новая задача в очереди — разбудить диспетчер."""
+        self._wake.set()
+
+    def _dispatcher(self):
+        while True:
+            self._slots.acquire()
+            job = None
+            while not job:
+                self._wake.clear()
+                try:
+                    job = claim_job()
+                except Exception as e:
+                    log(f'QUEUE ERR: {e}')
+                    time.sleep(QUEUE_POLL_SEC)
+                    continue
+                if not job:
+                    self._wake.wait(QUEUE_POLL_SEC)
+            filename, filepath, waited = job
+            if waited is not None:
+                STAGES.record('queue_wait', float(waited))
+            with self._lock:
+                self.active.add(filename)
+            started = time.monotonic()
+            fut = RUNNER.submit(transcribe_job(resolve_filepath(filepath), filename))
+            fut.add_done_callback(lambda fut, filename=filename, started=started: self._done(fut, filename, started))
+
+    def _done(self, fut, filename, started):
+        # Кэш-хиты, отложенные (AssemblyAI webhook) и упавшие задачи занижали бы среднее время задачи
+        if not fut.cancelled() and fut.exception() is None and fut.result():
+            STAGES.record('job', time.monotonic() - started)
+        with self._lock:
+            self.active.discard(filename)
+        self._slots.release()
+
+    def _housekeeper(self):
+        while True:
+            try:
+                with self._lock:
+                    active = list(self.active)
+                heartbeat_jobs(active)
+                for filename, status in requeue_expired():
+                    log(f'LEASE EXPIRED: {filename} -> {status}')
+                    if status == 'queued':
+                        self.notify()
+                # Сверка ходит в AssemblyAI (с повторами) — на RUNNER, не задерживая продление аренды;
+                # прошлый проход ещё идёт — этот тик пропускаем
+                busy = self._reconcile is not None and not self._reconcile.done()
+                if ASSEMBLYAI_WEBHOOK_BASE_URL and ASSEMBLYAI_API_KEY and not busy:
+                    self._reconcile = RUNNER.submit(reconcile_awaiting())
+                    self._reconcile.add_done_callback(self._reconciled)
+            except Exception as e:
+                log(f'HOUSEKEEPING ERR: {e}')
+            time.sleep(JOB_HEARTBEAT_SEC)
+
+    @staticmethod
+    def _reconciled(fut):
+        if not fut.cancelled() and fut.exception():
+            log(f'AssemblyAI reconcile ERR: {fut.exception()}')
+
+
+POOL = WorkerPool(WORKERS)
+
+
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+HTTP_PATHS = ('/', '/ingest', '/manifest/dirs', '/check', '/segments', '/health', '/healthz', '/livez', '/metrics', '/webhooks/assemblyai')
+
+
+def render_metrics():
+    """/metrics: накопленные счётчики и гистограммы + текущие значения (очередь, воркеры, breaker, пул БД)."""
+    try:
+        depth = queue_depth()
+    except Exception:
+        depth = None
+    pool = DB_POOL.stats()
+    try:
+        deadline = DEADLINE.estimate()
+    except Exception:
+        deadline = {}
+    gauges = [
+        ('transcribe_queue_depth', {}, depth),
+        ('transcribe_jobs_active', {}, len(POOL.active)),
+        ('transcribe_workers', {}, POOL.size),
+        ('transcribe_db_pool_in_use', {}, pool['in_use']),
+        ('transcribe_db_pool_timeouts_total', {}, pool['timeouts']),
+        ('transcribe_cache_lookups_total', {'result': 'hit'}, CACHE_STATS.hits),
+        ('transcribe_cache_lookups_total', {'result': 'miss'}, CACHE_STATS.misses),
+        ('transcribe_deadline_seconds_left', {}, deadline.get('seconds_left')),
+        ('transcribe_queue_drain_seconds', {'scope': 'fresh'}, deadline.get('fresh_drain_sec')),
+        ('transcribe_queue_drain_seconds', {'scope': 'all'}, deadline.get('drain_sec')),
+    ]
+    for name, _ in STT_ROUTES:
+        if name in PROVIDERS:
+            gauges.append(('transcribe_provider_inflight', {'provider': name}, PROVIDER_STATS[name].inflight))
+            gauges.append(('transcribe_breaker_state', {'provider': name}, BREAKER_STATE_VALUES[BREAKERS[name].state]))
+    return METRICS.render(gauges)
 
 
 # ── HTTP Handler ─────────────────────────────────────────────────────────────────────────────────────
 
 class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'     # keep-alive для n8n long-poll и healthcheck
+    timeout = HTTP_REQUEST_TIMEOUT_SEC  # медленный клиент / простой keep-alive не держит поток
+
     def log_message(self, format, *args):
         pass  # отключаем стандартный nginx-style лог
 
     def do_GET(self):
+        if self.path == '/livez':
+            self._send(200, {'status': 'alive'})
+            return
+        if self.path == '/metrics':
+            self._send(200, render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+            return
+        # /manifest/dirs — mtime каталогов для сверки watcher (после рестарта перечисляет только изменившиеся)
+        if self.path == '/manifest/dirs':
+            try:
+                self._send(200, {'dirs': load_manifest_dirs()})
+            except Exception as e:
+                log(f'HANDLER ERR: {e}')
+                self._send(500, {'error': str(e)})
+            return
         if self.path in ('/health', '/healthz'):
             issues = []
-            if STT_PROVIDER == 'speechkit' and not YANDEX_API_KEY:
+            routed = [name for name, _ in STT_ROUTES]
+            if 'speechkit' in routed and not YANDEX_API_KEY:
                 issues.append('YANDEX_API_KEY not set')
-            if STT_PROVIDER == 'assemblyai' and not ASSEMBLYAI_API_KEY:
+            if 'assemblyai' in routed and not ASSEMBLYAI_API_KEY:
                 issues.append('ASSEMBLYAI_API_KEY not set')
+            if 'local_whisper' in routed and LOCAL_WHISPER.error:
+                issues.append(f'local_whisper: {LOCAL_WHISPER.error}')
+            issues += [f'unknown provider {name}' for name in routed if name not in PROVIDERS]
+            info = {
+                'provider': STT_PROVIDER,
+                'routes': [f'{name}:{max_sec:g}' if max_sec else name for name, max_sec in STT_ROUTES],
+                'providers': {name: {**PROVIDER_STATS[name].as_dict(), 'breaker': BREAKERS[name].as_dict()}
+                              for name in routed if name in PROVIDERS},
+                'workers': {'size': POOL.size, 'active': len(POOL.active), 'threads': threading.active_count()},
+                'cache': CACHE_STATS.as_dict(),
+                'db_pool': DB_POOL.stats(),
+                'stages': STAGES.as_dict(),
+            }
+            try:
+                info['deadline'] = DEADLINE.estimate()
+            except Exception as e:
+                issues.append(f'deadline estimate: {e}')
+            if 'local_whisper' in routed:
+                info['local_whisper'] = LOCAL_WHISPER.as_dict()
             if issues:
-                self._send(500, {'status': 'error', 'provider': STT_PROVIDER, 'issues': issues})
+                self._send(500, {'status': 'error', **info, 'issues': issues})
             else:
-                self._send(200, {'status': 'ok', 'provider': STT_PROVIDER})
+                self._send(200, {'status': 'ok', **info})
             return
         self._send(404, {'error': 'not found'})
 
     def do_POST(self):
         try:
             length = int(self.headers.get('Content-Length', 0))
+            if length > HTTP_MAX_BODY_BYTES:
+                self.close_connection = True
+                self._send(413, {'error': 'request body too large', 'limit': HTTP_MAX_BODY_BYTES})
+                return
             raw = self.rfile.read(length) if length > 0 else b''
             body = json.loads(raw.decode('utf-8')) if raw else {}
 
-            # /check — вернуть транскрипт из БД
+            # /webhooks/assemblyai — AssemblyAI закончил задачу
+            if urllib.parse.urlsplit(self.path).path == '/webhooks/assemblyai':
+                if not ASSEMBLYAI_WEBHOOK_SECRET or self.headers.get('X-Webhook-Secret') != ASSEMBLYAI_WEBHOOK_SECRET:
+                    self._send(401, {'error': 'bad webhook secret'})
+                    return
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+                filename = (query.get('filename') or [''])[0]
+                transcript_id = body.get('transcript_id')
+                if not filename or not transcript_id:
+                    self._send(400, {'error': 'filename and transcript_id required'})
+                    return
+                # Транскрипт привязан к задаче в defer_job: чужой id или задача не в
+                # awaiting_provider (ещё в работе у воркера, уже завершена) — 409
+                row = job_status(filename)
+                if not row or row[0] != 'awaiting_provider' or row[2] != transcript_id:
+                    log(f'AssemblyAI webhook: {filename} {transcript_id} rejected '
+                        f'({row[0] if row else "not_found"})')
+                    self._send(409, {'error': 'no job awaiting this transcript',
+                                     'status': row[0] if row else 'not_found'})
+                    return
+                log(f'AssemblyAI webhook: {filename} {transcript_id} {body.get("status")}')
+                RUNNER.submit(self._complete_assemblyai(filename, row[2]))
+                self._send(200, {'status': 'accepted'})
+                return
+
+            # /check — вернуть транскрипт из БД (wait > 0 — long-poll до завершения)
             if self.path == '/check':
                 filename = body.get('filename', '')
-                conn = psycopg2.connect(DB_DSN)
-                cur = conn.cursor()
-                cur.execute('SELECT transcript_text, status FROM processed_files WHERE filename=%s', (filename,))
-                row = cur.fetchone()
-                conn.close()
+                try:
+                    wait = float(body.get('wait') or 0)
+                    if not math.isfinite(wait):
+                        raise ValueError
+                except (TypeError, ValueError):
+                    self._send(400, {'error': 'wait must be a number (seconds)'})
+                    return
+                # Долгий wait держит поток сервера — не дольше CHECK_MAX_WAIT_SEC
+                row = check_transcript(filename, min(max(wait, 0.0), CHECK_MAX_WAIT_SEC))
                 if row and row[0]:
-                    self._send(200, {'transcript': row[0], 'status': row[1]})
+                    self._send(200, {'transcript': row[0], 'status': row[1], 'progress': 100})
                 else:
-                    self._send(200, {'transcript': None, 'status': row[1] if row else 'not_found'})
+                    self._send(200, {'transcript': None, 'status': row[1] if row else 'not_found',
+                                     'progress': row[2] if row else None})
+                return
+
+            # /segments — сегменты с таймингами; from/to (сек) — только пересекающие интервал,
+            # speaker (строка или список) — только реплики этих говорящих
+            if self.path == '/segments':
+                filename = body.get('filename', '')
+                speakers, start, end = body.get('speaker'), body.get('from'), body.get('to')
+                try:
+                    if isinstance(speakers, str):
+                        speakers = {speakers}
+                    elif speakers is not None:
+                        if not isinstance(speakers, list) or not all(isinstance(sp, str) for sp in speakers):
+                            raise ValueError
+                        speakers = set(speakers)
+                    start = float(start) if start is not None else None
+                    end = float(end) if end is not None else None
+                    if not all(math.isfinite(t) for t in (start, end) if t is not None):
+                        raise ValueError
+                except (TypeError, ValueError):
+                    self._send(400, {'error': 'speaker — string or list of strings, from/to — numbers (seconds)'})
+                    return
+                row = load_segments(filename)
+                segments = unpack_segments(row[1]) if row else []
+                if speakers is not None:
+                    segments = [seg for seg in segments if seg['speaker'] in speakers]
+                if start is not None:
+                    segments = [seg for seg in segments if seg['end'] > start]
+                if end is not None:
+                    segments = [seg for seg in segments if seg['start'] < end]
+                self._send(200, {'filename': filename, 'status': row[0] if row else 'not_found',
+                                 'segments': segments})
+                return
+
+            # /ingest — пачка обнаруженных файлов (watcher): в очередь только новые
+            if self.path == '/ingest':
+                files, dirs = body.get('files'), body.get('dirs')
+                if not isinstance(files, list):
+                    self._send(400, {'error': 'files (list) required'})
+                    return
+                try:
+                    priority = parse_priority(body.get('priority'))
+                    for d in dirs or ():
+                        if not isinstance(d.get('path'), str) or not d['path']:
+                            raise ValueError
+                        if d.get('mtime') is not None:
+                            float(d['mtime'])
+                except (AttributeError, TypeError, ValueError):
+                    self._send(400, {'error': 'priority must be an integer, dirs — [{path, mtime}]'})
+                    return
+                # Битые записи пропускаются и возвращаются в invalid — остальная пачка принимается
+                valid, invalid = [], []
+                for index, entry in enumerate(files):
+                    try:
+                        valid.append(ingest_entry(entry))
+                    except ValueError as e:
+                        invalid.append({'index': index, 'error': str(e)})
+                new = ingest_files(valid, priority, dirs)
+                METRICS.inc('transcribe_ingested_files_total', len(new), result='new')
+                METRICS.inc('transcribe_ingested_files_total', len(valid) - len(new), result='known')
+                METRICS.inc('transcribe_ingested_files_total', len(invalid), result='invalid')
+                if invalid:
+                    log(f'INGEST: {len(invalid)} invalid entries skipped, first: #{invalid[0]["index"]} '
+                        f'{invalid[0]["error"]}')
+                if new:
+                    log(f'INGEST: {len(new)} new of {len(valid)}')
+                    POOL.notify()
+                self._send(200, {'new': [{'filename': name, 'filepath': path} for name, path in new],
+                                 'known': len(valid) - len(new), 'invalid': invalid})
                 return
 
-            # / — запустить транскрипцию
+            # / — поставить в очередь
             filepath = resolve_filepath(body.get('filepath', ''))
             filename = body.get('filename') or filepath.split('/')[-1]
             log(f'REQUEST: {filename}')
@@ -308,25 +2774,103 @@ class Handler(BaseHTTPRequestHandler):
                 self._send(400, {'error': 'file not found', 'path': filepath})
                 return
 
-            t = threading.Thread(target=transcribe_async, args=(filepath, filename))
-            t.daemon = True
-            t.start()
+            callback_url = body.get('callback_url') or None
+            if callback_url and urllib.parse.urlsplit(callback_url).scheme not in ('http', 'https'):
+                self._send(400, {'error': 'callback_url must be http(s)', 'callback_url': callback_url})
+                return
+            try:
+                priority = parse_priority(body.get('priority'))
+            except ValueError:
+                self._send(400, {'error': 'priority must be an integer'})
+                return
+
+            # Backpressure: провайдеры недоступны или очередь переполнена — клиент повторит позже
+            retry_after = routes_retry_after()
+            if retry_after:
+                log(f'REJECTED: {filename}: all providers unavailable, retry in {retry_after}s')
+                self._send(503, {'error': 'STT providers unavailable', 'retry_after': retry_after},
+                           headers={'Retry-After': str(retry_after)})
+                return
+            if QUEUE_MAX_DEPTH and queue_depth() >= QUEUE_MAX_DEPTH:
+                log(f'REJECTED: {filename}: queue full ({QUEUE_MAX_DEPTH})')
+                self._send(429, {'error': 'queue full', 'retry_after': QUEUE_RETRY_AFTER_SEC},
+                           headers={'Retry-After': str(QUEUE_RETRY_AFTER_SEC)})
+                return
+
+            queued, status = enqueue_job(filename, filepath, priority, callback_url,
+                                         requeue=body.get('requeue') is True)
+            if queued:
+                POOL.notify()
+            else:
+                log(f'ALREADY {status.upper()}: {filename}')
 
-            self._send(200, {'status': 'processing', 'filename': filename, 'provider': STT_PROVIDER})
+            self._send(200, {'status': status, 'filename': filename, 'provider': STT_PROVIDER})
 
+        except TimeoutError:
+            self.close_connection = True
+            self._send(408, {'error': 'request timeout'})
         except Exception as e:
             log(f'HANDLER ERR: {e}')
             self._send(500, {'error': str(e)})
 
-    def _send(self, code, data):
-        self.send_response(code)
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+    @staticmethod
+    async def _complete_assemblyai(filename, transcript_id):
+        try:
+            await complete_assemblyai(filename, transcript_id)
+        except Exception as e:
+            log(f'AssemblyAI webhook ERR: {filename}: {e}')
+
+    def _send(self, code, data, headers=None, content_type='application/json'):
+        """JSON-ответ; строка data отправляется как есть (content_type — напр. для /metrics)."""
+        path = urllib.parse.urlsplit(self.path).path
+        METRICS.inc('transcribe_http_requests_total', path=path if path in HTTP_PATHS else 'other', code=code)
+        payload = (data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)).encode('utf-8')
+        try:
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # клиент ушёл (таймаут n8n) — не ошибка сервиса
+
+
+class TranscribeHTTPServer(ThreadingHTTPServer):
+    """Поток на соединение: long-poll /check и медленные запросы не блокируют /livez и /health."""
+    daemon_threads = True
+    request_queue_size = 128
 
 
 # ── Entrypoint ─────────────────────────────────────────────────────────────────────────────────────────
 
+def _shutdown(signum, frame):
+    raise SystemExit(0)
+
+
 if __name__ == '__main__':
-    log(f'TRANSCRIBE SERVER START — provider={STT_PROVIDER}, port={PORT}')
-    HTTPServer(('0.0.0.0', PORT), Handler).serve_forever()
+    LOG_LISTENER.start()
+    if ASSEMBLYAI_WEBHOOK_BASE_URL and not ASSEMBLYAI_WEBHOOK_SECRET:
+        log('ERR: ASSEMBLYAI_WEBHOOK_BASE_URL is set without ASSEMBLYAI_WEBHOOK_SECRET')
+        LOG_LISTENER.stop()
+        sys.exit(1)
+    log(f'TRANSCRIBE SERVER START — provider={STT_PROVIDER}, routes={STT_ROUTES}, port={PORT}, '
+        f'workers={WORKERS}, id={WORKER_ID}')
+    signal.signal(signal.SIGTERM, _shutdown)
+    RUNNER.start()
+    if any(name == 'local_whisper' for name, _ in STT_ROUTES):
+        # Модель (сотни MB, при первом запуске — скачивание) грузится в фоне: /livez отвечает сразу
+        threading.Thread(target=LOCAL_WHISPER.load, name='local-whisper-load', daemon=True).start()
+    POOL.start()
+    try:
+        TranscribeHTTPServer(('0.0.0.0', PORT), Handler).serve_forever()
+    finally:
+        try:
+            for filename in release_leases():
+                log(f'RELEASED: {filename}')
+        except Exception as e:
+            log(f'RELEASE ERR: {e}')
+        LOG_LISTENER.stop()  # дописать очередь лога до выхода
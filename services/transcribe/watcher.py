@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Recording Watcher — обнаружение новых записей в /recordings без периодического find.
+
+inotify на каждый каталог дерева (/recordings/YYYY/MM/DD): файл, закрытый после записи
+(IN_CLOSE_WRITE) или переименованный в каталог (IN_MOVED_TO), сразу уходит в POST /ingest
+transcribe — новая строка processed_files со status=queued, диспетчер будится сразу.
+Файлы, о закрытии которых событий нет (запись с другого хоста по NFS/SMB, события потеряны
+при переполнении очереди inotify), подхватывает сверка: обход дерева раз в WATCH_SWEEP_SEC;
+такой файл ставится в очередь, когда его размер не меняется WATCH_STABLE_SEC. Сверка
+перечисляет только каталоги, чей mtime изменился с прошлого просмотра (манифест каталогов
+в БД, переживает рестарт), — её время пропорционально изменениям, а не размеру архива.
+Уже известные файлы (любой статус в processed_files) не трогаются; найденное отправляется
+пачками по WATCH_BATCH — один запрос на пачку, а не на файл.
+"""
+
+import collections, ctypes, ctypes.util, os, select, signal, struct, sys, time
+import httpx
+
+# ── Конфигурация ─────────────────────────────────────────────────────────────────────────────
+
+WATCH_DIR = os.getenv('WATCH_DIR', '/recordings')
+# Расширения записей — те же, что были в WF01 (List Recording Files)
+WATCH_EXTENSIONS = tuple(
+    ext.strip().lower() for ext in os.getenv('WATCH_EXTENSIONS', '.webm,.mp3,.ogg,.wav').split(',') if ext.strip()
+)
+# Файлы крупнее не ставятся в очередь (как tooLarge в WF01: 100 MB); 0 — без ограничения
+WATCH_MAX_BYTES = int(os.getenv('WATCH_MAX_BYTES', str(100 * 1024 * 1024)))
+# Файл без IN_CLOSE_WRITE считается записанным, если размер и mtime не менялись столько секунд
+WATCH_STABLE_SEC = float(os.getenv('WATCH_STABLE_SEC', '10'))
+# Сверка всего дерева с очередью (fallback на случай пропущенных событий)
+WATCH_SWEEP_SEC = float(os.getenv('WATCH_SWEEP_SEC', '300'))
+WATCH_PRIORITY = int(os.getenv('WATCH_PRIORITY', '0'))
+# Файлов в одном POST /ingest (тело запроса — до HTTP_MAX_BODY_BYTES сервиса)
+WATCH_BATCH = int(os.getenv('WATCH_BATCH', '500'))
+TRANSCRIBE_URL = os.getenv('TRANSCRIBE_URL', 'http://transcribe:9001').rstrip('/')
+# transcribe недоступен — повтор отправки через столько секунд
+WATCH_RETRY_SEC = float(os.getenv('WATCH_RETRY_SEC', '10'))
+# Сколько отправленных имён помнить; вытесненное при пересканировании каталога уйдёт
+# в /ingest повторно — сервер отбросит его как известное
+WATCH_KNOWN_MAX = int(os.getenv('WATCH_KNOWN_MAX', '100000'))
+
+
+def log(msg):
+    print(f'[{time.strftime("%Y-%m-%d %H:%M:%S")}] [WATCHER] {msg}', flush=True)
+
+
+def is_recording(name):
+    return not name.startswith('.') and name.lower().endswith(WATCH_EXTENSIONS)
+
+
+# ── inotify (ctypes, без внешних зависимостей) ─────────────────────────────────────────────────
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class Inotify:
+    """Минимальная обёртка над inotify_init1/inotify_add_watch: watch на каталог, чтение событий."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'inotify_init1: {os.strerror(err)}')
+        self.paths = {}  # wd → каталог
+        self.wds = {}    # каталог → wd
+
+    def add_watch(self, path):
+        if path in self.wds:
+            return self.wds[path]
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'inotify_add_watch {path}: {os.strerror(err)}')
+        self.paths[wd] = path
+        self.wds[path] = wd
+        return wd
+
+    def forget(self, wd):
+        path = self.paths.pop(wd, None)
+        if path is not None:
+            self.wds.pop(path, None)
+
+    def read(self, timeout):
+        """События за timeout сек: [(каталог, mask, имя)]; для IN_Q_OVERFLOW каталог — None."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((self.paths.get(wd), mask, name))
+            if mask & IN_IGNORED:
+                self.forget(wd)
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# ── Watcher ──────────────────────────────────────────────────────────────────────────────────────
+
+class Watcher:
+    """
+    Держит watch на всех каталогах WATCH_DIR, отправляет в /ingest записанные файлы.
+    pending — файлы, которые ещё пишутся: путь → (размер, mtime, когда размер менялся последний раз).
+    ready — записанные, ждут отправки: путь → (размер, mtime).
+    known — имена, уже переданные в /ingest: повторная сверка их не отправляет
+    (LRU до WATCH_KNOWN_MAX — память watcher'а не растёт с архивом).
+    dirs / children — манифест каталогов (mtime на момент просмотра, подкаталоги), из
+    GET /manifest/dirs при старте; scanned — просмотренные каталоги, ещё не записанные в манифест.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.inotify = None
+        self.pending = {}
+        self.ready = {}
+        self.known = collections.OrderedDict()
+        self.dirs = {}
+        self.children = {}
+        self.scanned = {}
+        self.retry_at = 0.0
+        self.client = httpx.Client(timeout=30)
+        self.stopped = False
+
+    # Очередь transcribe
+
+    def load_manifest(self):
+        """mtime каталогов с прошлых сверок: после рестарта перечисляются только изменившиеся."""
+        while not self.stopped:
+            try:
+                r = self.client.get(f'{TRANSCRIBE_URL}/manifest/dirs')
+                r.raise_for_status()
+                self.dirs = r.json()['dirs']
+                break
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                log(f'MANIFEST ERR: {e} — повтор через {WATCH_RETRY_SEC:.0f}s')
+                time.sleep(WATCH_RETRY_SEC)
+        self.children = {}
+        for path in self.dirs:
+            if path != self.root:
+                self.children.setdefault(os.path.dirname(path), []).append(path)
+        log(f'manifest: {len(self.dirs)} dirs')
+
+    def enqueue(self, filepath, st=None):
+        name = os.path.basename(filepath)
+        if name in self.known or not is_recording(name):
+            return
+        try:
+            st = st or os.stat(filepath)
+        except OSError:
+            return
+        if WATCH_MAX_BYTES and st.st_size > WATCH_MAX_BYTES:
+            # в known — чтобы сверка не находила его снова
+            log(f'TOO LARGE: {filepath} ({st.st_size / 1048576:.0f} MB > {WATCH_MAX_BYTES / 1048576:.0f} MB), skipped')
+            self.remember(name)
+            return
+        self.ready[filepath] = (st.st_size, st.st_mtime)
+
+    def flush(self):
+        """
+        ready → POST /ingest пачками; transcribe недоступен — ready ждёт WATCH_RETRY_SEC.
+        mtime каталога уходит в манифест вместе с первой пачкой, когда все его файлы отправлены:
+        иначе после рестарта каталог не перечислится и недописанный файл потеряется.
+        """
+        if time.monotonic() < self.retry_at:
+            return
+        busy = {os.path.dirname(path) for path in (*self.pending, *self.ready)}
+        dirs = {path: mtime for path, mtime in self.scanned.items() if path not in busy}
+        if not self.ready and not dirs:
+            return
+        items = list(self.ready.items())
+        batches = [items[i:i + WATCH_BATCH] for i in range(0, len(items), WATCH_BATCH)] or [[]]
+        for n, batch in enumerate(batches):
+            payload = {
+                'priority': WATCH_PRIORITY,
+                'files': [{'filepath': path, 'size': size, 'mtime': mtime} for path, (size, mtime) in batch],
+            }
+            if n == 0 and dirs:
+                payload['dirs'] = [{'path': path, 'mtime': mtime} for path, mtime in dirs.items()]
+            try:
+                r = self.client.post(f'{TRANSCRIBE_URL}/ingest', json=payload)
+                r.raise_for_status()
+                new = r.json()['new']
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                log(f'INGEST ERR: {e} — повтор через {WATCH_RETRY_SEC:.0f}s ({len(self.ready)} файлов)')
+                self.retry_at = time.monotonic() + WATCH_RETRY_SEC
+                return
+            if n == 0:
+                for path, mtime in dirs.items():
+                    self.scanned.pop(path, None)
+                    if mtime is not None:
+                        self.dirs[path] = mtime
+            for path, _ in batch:
+                self.ready.pop(path, None)
+                self.remember(os.path.basename(path))
+            for item in new:
+                log(f'ENQUEUED: {item["filepath"]}')
+            if len(batch) > len(new):
+                log(f'KNOWN: {len(batch) - len(new)} of {len(batch)}')
+
+    def remember(self, name):
+        self.known[name] = None
+        self.known.move_to_end(name)
+        if len(self.known) > WATCH_KNOWN_MAX:
+            self.known.popitem(last=False)
+
+    # Дерево
+
+    def walk(self, top):
+        """
+        Watch на top и все подкаталоги. Каталог, чей mtime не изменился с прошлого просмотра,
+        не перечисляется: подкаталоги — из манифеста, новых файлов в нём нет. В изменившихся
+        файлы — в pending. Возвращает число перечисленных каталогов.
+        """
+        stack, listed = [top], 0
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                self.forget_dir(path)
+                continue
+            if self.inotify:
+                try:
+                    self.inotify.add_watch(path)
+                except OSError as e:
+                    log(f'WATCH ERR: {e} — каталог только в сверке')
+            if self.dirs.get(path) == mtime:
+                stack.extend(self.children.get(path, ()))
+                continue
+            subdirs = []
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif is_recording(entry.name) and entry.name not in self.known:
+                            self.track(entry.path)
+            except OSError as e:
+                log(f'SCAN ERR: {e}')
+                continue
+            listed += 1
+            for gone in set(self.children.get(path, ())) - set(subdirs):
+                self.forget_dir(gone)
+            self.children[path] = subdirs
+            self.scanned[path] = mtime
+            stack.extend(subdirs)
+        return listed
+
+    def forget_dir(self, path):
+        """Каталог удалён — из манифеста вместе с подкаталогами (сервер удаляет по префиксу)."""
+        for child in self.children.pop(path, ()):
+            self.forget_dir(child)
+        self.scanned.pop(path, None)
+        if self.dirs.pop(path, None) is not None:
+            self.scanned[path] = None
+
+    def track(self, filepath):
+        """Файл пишется (или записан без события) — ждём стабильного размера."""
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            self.pending.pop(filepath, None)
+            return
+        prev = self.pending.get(filepath)
+        if prev and prev[:2] == (st.st_size, st.st_mtime):
+            return
+        # mtime старше WATCH_STABLE_SEC — файл дописан до старта/сверки, ждать не нужно
+        changed = time.monotonic() - max(0.0, min(WATCH_STABLE_SEC, time.time() - st.st_mtime))
+        self.pending[filepath] = (st.st_size, st.st_mtime, changed)
+
+    def check_pending(self):
+        now = time.monotonic()
+        for filepath, (size, mtime, changed) in list(self.pending.items()):
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                self.pending.pop(filepath, None)
+                continue
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                self.pending[filepath] = (st.st_size, st.st_mtime, now)
+            elif now - changed >= WATCH_STABLE_SEC:
+                self.pending.pop(filepath, None)
+                self.enqueue(filepath, st)
+
+    def handle(self, dirpath, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log('inotify queue overflow — внеочередная сверка')
+            self.sweep()
+            return
+        if dirpath is None or not name:
+            return
+        path = os.path.join(dirpath, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith('.'):
+                self.walk(path)
+            return
+        if not is_recording(name):
+            return
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self.pending.pop(path, None)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            # запись закончена (или файл переименован в каталог целиком)
+            self.pending.pop(path, None)
+            self.enqueue(path)
+        elif mask & (IN_CREATE | IN_MODIFY) and name not in self.known:
+            self.track(path)
+
+    def sweep(self):
+        started = time.monotonic()
+        before = len(self.pending)
+        listed = self.walk(self.root)
+        self.check_pending()
+        log(f'SWEEP: {listed} of {len(self.children.keys() | self.dirs.keys())} dirs listed, '
+            f'{len(self.pending)} pending (было {before}), {len(self.ready)} ready, '
+            f'{len(self.inotify.wds) if self.inotify else 0} watches, {time.monotonic() - started:.1f}s')
+
+    def run(self):
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            log(f'inotify недоступен ({e}) — только сверка раз в {WATCH_SWEEP_SEC:.0f}s')
+        self.load_manifest()
+        next_sweep = 0.0
+        while not self.stopped:
+            now = time.monotonic()
+            if now >= next_sweep:
+                self.sweep()
+                next_sweep = now + WATCH_SWEEP_SEC
+            # pending проверяется чаще, чем стабилизируется размер
+            timeout = min(WATCH_STABLE_SEC / 2, max(0.0, next_sweep - now)) if self.pending else \
+                max(0.0, next_sweep - now)
+            if self.inotify:
+                try:
+                    events = self.inotify.read(min(timeout, 1.0))
+                except InterruptedError:
+                    events = []
+                for dirpath, mask, name in events:
+                    self.handle(dirpath, mask, name)
+            else:
+                time.sleep(min(timeout, 1.0))
+            if self.pending:
+                self.check_pending()
+            self.flush()
+        if self.inotify:
+            self.inotify.close()
+        self.client.close()
+
+
+# ── Entrypoint ─────────────────────────────────────────────────────────────────────────────────────────
+
+if __name__ == '__main__':
+    if not os.path.isdir(WATCH_DIR):
+        log(f'{WATCH_DIR} не найден')
+        sys.exit(1)
+    log(f'WATCHER START — dir={WATCH_DIR}, ingest={TRANSCRIBE_URL}/ingest, extensions={",".join(WATCH_EXTENSIONS)}, '
+        f'stable={WATCH_STABLE_SEC:.0f}s, sweep={WATCH_SWEEP_SEC:.0f}s')
+    watcher = Watcher(WATCH_DIR)
+
+    def _stop(signum, frame):
+        log(f'signal {signum}: остановка')
+        watcher.stopped = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    watcher.run()